@@ -1,44 +1,120 @@
+import asyncio
+import atexit
+import random
+import re
+import threading
 import time
 import os
-import csv
+import itertools
+import importlib.util
+import logging
+import queue
+from collections import OrderedDict, deque
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Literal, get_args
+import httpx
+import numpy as np
+import pandas as pd
 from google import genai
-from firebase_manager import db, get_full_state, reset_simulation
+from google.genai import types
+from pydantic import BaseModel
+from firebase_manager import apply_update, db, get_full_state, listen_state, reset_simulation
+
+
+# KEY = value lines; '#' comments and lines without '=' never match.
+# Surrounding whitespace and double quotes are dropped from the value.
+_ENV_LINE = re.compile(r'^[ \t]*([^#\s=][^=\n]*?)[ \t]*=[ \t]*"*([^\n]*?)"*[ \t\r]*$', re.MULTILINE)
+_LOADED_ENV_FILES = set()
 
 
 def _load_env_file(path: str = ".env") -> None:
-    if not os.path.exists(path):
+    if path in _LOADED_ENV_FILES or not os.path.exists(path):
         return
     with open(path, "r", encoding="utf-8") as env_file:
-        for line in env_file:
-            line = line.strip()
-            if not line or line.startswith("#") or "=" not in line:
-                continue
-            key, value = line.split("=", 1)
-            key = key.strip()
-            value = value.strip().strip("\"")
-            if key and key not in os.environ:
-                os.environ[key] = value
+        for key, value in _ENV_LINE.findall(env_file.read()):
+            os.environ.setdefault(key, value)
+    _LOADED_ENV_FILES.add(path)
 
 
 _load_env_file()
 
 # --- CONFIGURATION ---
-# Load API key from environment variable
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Environment settings, parsed once at import into native types."""
+    gemini_api_key: str
+    gemini_timeout_ms: int
+    model_name: str
+    gemini_max_concurrent: int
+    gemini_explicit_cache: bool
+    gemini_cache_ttl: str
+    list_models: bool
+    use_mock: bool
+    loop_delay: int            # Seconds between iterations (3s per 30-min step)
+    max_loop_delay: float      # Backoff cap while Gemini quota is exhausted
+    sim_data_path: str
+    step_minutes: float        # 30-minute simulation steps
+    battery_capacity_kwh: float
+    p2p_trade_kwh: float
+    grid_charge_kwh: float
+    log_level: str
+
+
+def _log_level(value: str) -> str:
+    """Normalise LOG_LEVEL; empty means INFO, unknown names are rejected."""
+    level = (value or "INFO").strip().upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise RuntimeError(f"Unknown LOG_LEVEL {value!r}. Use DEBUG, INFO, WARNING, ERROR or CRITICAL.")
+    return level
+
+
+def _load_config() -> Config:
+    env = os.environ
+    return Config(
+        gemini_api_key=env.get("GEMINI_API_KEY", ""),
+        gemini_timeout_ms=int(env.get("GEMINI_TIMEOUT_MS") or "60000"),
+        model_name=env.get("GEMINI_MODEL", "gemini-2.5-flash"),
+        gemini_max_concurrent=int(env.get("GEMINI_MAX_CONCURRENT") or "2"),
+        gemini_explicit_cache=env.get("GEMINI_EXPLICIT_CACHE", "false").lower() == "true",
+        gemini_cache_ttl=env.get("GEMINI_CACHE_TTL", "3600s"),
+        list_models=bool(env.get("GEMINI_LIST_MODELS")),
+        use_mock=env.get("USE_MOCK_AGENTS", "false").lower() == "true",
+        loop_delay=int(env.get("LOOP_DELAY", "3").strip() or "3"),
+        max_loop_delay=float(env.get("MAX_LOOP_DELAY") or "60"),
+        sim_data_path=env.get("SIMULATION_DATA_PATH", "simulation_data.csv"),
+        step_minutes=float(env.get("SIMULATION_STEP_MINUTES", "30")),
+        battery_capacity_kwh=float(env.get("BATTERY_CAPACITY_KWH", "10")),
+        p2p_trade_kwh=float(env.get("P2P_TRADE_KWH", "0.5")),
+        grid_charge_kwh=float(env.get("GRID_CHARGE_KWH", "0.5")),
+        log_level=_log_level(env.get("LOG_LEVEL")),
+    )
+
+
+CFG = _load_config()
+if not CFG.gemini_api_key:
     raise RuntimeError("GEMINI_API_KEY environment variable not set. Copy .env.example to .env and fill in your API key.")
-client = genai.Client(api_key=GEMINI_API_KEY)
-MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-LIST_MODELS = os.getenv("GEMINI_LIST_MODELS")
-USE_MOCK = os.getenv("USE_MOCK_AGENTS", "false").lower() == "true"
-_loop_delay_raw = os.getenv("LOOP_DELAY", "3").strip()
-LOOP_DELAY = int(_loop_delay_raw) if _loop_delay_raw else 3  # Seconds between iterations (3s per 30-min step)
-SIM_DATA_PATH = os.getenv("SIMULATION_DATA_PATH", "simulation_data.csv")
-STEP_MINUTES = float(os.getenv("SIMULATION_STEP_MINUTES", "30"))  # 30-minute simulation steps
-
-BATTERY_CAPACITY_KWH = float(os.getenv("BATTERY_CAPACITY_KWH", "10"))
-P2P_TRADE_KWH = float(os.getenv("P2P_TRADE_KWH", "0.5"))
-GRID_CHARGE_KWH = float(os.getenv("GRID_CHARGE_KWH", "0.5"))
+# Keep TLS connections to the Gemini endpoint alive between loop iterations, and
+# multiplex concurrent requests over one HTTP/2 connection when h2 is installed
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=16, keepalive_expiry=60)
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_HTTP_CLIENT_ARGS = {"limits": _HTTP_LIMITS, "http2": _HTTP2}
+client = genai.Client(
+    api_key=CFG.gemini_api_key,
+    http_options=types.HttpOptions(
+        timeout=CFG.gemini_timeout_ms,
+        client_args=_HTTP_CLIENT_ARGS,
+        async_client_args=_HTTP_CLIENT_ARGS,
+    ),
+)
+GEMINI_MAX_RETRIES = 3  # 429 retries (1s, 2s, 4s backoff) before the mock fallback
+
+# Battery percentage moved by one grid charge/sale and by one fixed-size P2P trade
+_GRID_CHARGE_PCT = (CFG.grid_charge_kwh / CFG.battery_capacity_kwh) * 100.0
+_P2P_DELTA_PCT = (CFG.p2p_trade_kwh / CFG.battery_capacity_kwh) * 100.0
+# Battery percentage moved per kW of net generation over one simulation step
+_STEP_HOURS = CFG.step_minutes / 60.0
+_BATT_KW_TO_PCT = _STEP_HOURS / CFG.battery_capacity_kwh * 100.0
 
 # --- WAPDA PRICING & TRANSMISSION ---
 WAPDA_GENERATION_COST = 11.0  # WAPDA buys 1 unit for 11 rupees
@@ -46,56 +122,501 @@ WAPDA_PEAK_PRICE = 48.0       # WAPDA sells 1 unit at 48 rupees during peak
 WAPDA_OFFPEAK_PRICE = 38.0    # WAPDA sells 1 unit at 38 rupees off-peak
 TRANSMISSION_RENT_PER_UNIT = 18.0  # Wire rental charged to buyer
 
+# --- DECISION CACHE ---
+# The rules are deterministic, so states that quantize to the same bucket
+# (see EnergyAgent._state_key) reuse one Gemini answer instead of a new call.
+DECISION_CACHE_SIZE = 4096
+_DECISION_CACHE: OrderedDict = OrderedDict()  # state bucket tuple -> (action, reasoning)
+
+
+def _cache_get(key: tuple):
+    decision = _DECISION_CACHE.get(key)
+    if decision is not None:
+        _DECISION_CACHE.move_to_end(key)
+    return decision
+
+
+def _cache_put(key: tuple, decision: tuple) -> None:
+    _DECISION_CACHE[key] = decision
+    _DECISION_CACHE.move_to_end(key)
+    if len(_DECISION_CACHE) > DECISION_CACHE_SIZE:
+        _DECISION_CACHE.popitem(last=False)
+
+
+# --- AGENT PROMPT ---
+# Static rules go in the system instruction so every request shares a
+# byte-identical prefix (Gemini implicit caching); only the short status
+# block from generate_prompt changes between calls.
+_RULES_PROMPT = """
+*** CRITICAL CONSTRAINT ***
+NEVER EVER sell (OFFER_P2P or SELL_TO_GRID) when Solar Output < 0.1 kW.
+At night, you have NO SOLAR to sell. Period.
+
+STRICT RULES:
+1. NIGHT MODE (Solar < 0.1): MUST NOT sell. You are consuming.
+    - Only actions: "CHARGE_FROM_GRID", "HOLD", "BUY_P2P"
+    - If Battery < 40% and Price is Cheap -> ACTION: "CHARGE_FROM_GRID"
+    - If Battery is fine -> ACTION: "HOLD"
+    - NEVER OFFER_P2P or SELL_TO_GRID at night.
+
+2. DAY MODE (Solar > 0.5): You have solar generation.
+    - If Net Generation > 1.0 AND Grid is Expensive (>40) -> ACTION: "OFFER_P2P" (Only action for selling)
+    - If Net Generation > 1.0 AND Grid is Cheap (<30) -> ACTION: "CHARGE_BATTERY" (Store it).
+    - If Battery Low -> ACTION: "CHARGE_FROM_GRID"
+    - Else -> ACTION: "HOLD"
+
+3. BUYER MODE (If needed): Only "BUY_P2P" when Battery < 30% and need power.
+
+4. CHARITY WINDOW (15:00-16:00 with Solar): Only "DONATE_MASJID".
+
+DECISION FORMAT:
+Return exactly: "ACTION | REASONING"
+Allowed Actions: "HOLD", "CHARGE_FROM_GRID", "CHARGE_BATTERY", "SELL_TO_GRID", "OFFER_P2P", "BUY_P2P", "DONATE_MASJID"
+"""
+
+_STATIC_SYSTEM_PROMPT = """
+You are a Smart Energy Agent for a house in a Pakistani P2P microgrid.
+Each message gives you your house, its role, and the current DATA block.
+""" + _RULES_PROMPT
+_SYSTEM_PROMPT_PRODUCER = """
+You are the Smart Energy Agent for a PRODUCER house in a Pakistani P2P microgrid.
+Each message gives you the house's current DATA block.
+""" + _RULES_PROMPT
+_SYSTEM_PROMPT_CONSUMER = """
+You are the Smart Energy Agent for a CONSUMER house in a Pakistani P2P microgrid.
+Each message gives you the house's current DATA block.
+""" + _RULES_PROMPT
+
+
+Action = Literal[
+    "HOLD", "CHARGE_FROM_GRID", "CHARGE_BATTERY", "SELL_TO_GRID", "OFFER_P2P", "BUY_P2P", "DONATE_MASJID"
+]
+_ACTIONS = frozenset(get_args(Action))
+
+
+class Decision(BaseModel):
+    action: Action
+    reasoning: str
+
+
+class DecisionPair(BaseModel):
+    """Structured answer for the joint call; Gemini fills it via response_schema."""
+    house_a: Decision
+    house_b: Decision
+
+
+# Single-agent calls use their role's prompt; joint (multi-house) calls use the shared one
+_SYSTEM_PROMPTS = {
+    "JOINT": _STATIC_SYSTEM_PROMPT,
+    "PRODUCER": _SYSTEM_PROMPT_PRODUCER,
+    "CONSUMER": _SYSTEM_PROMPT_CONSUMER,
+}
+_GENERATE_CONFIGS = {
+    kind: types.GenerateContentConfig(system_instruction=prompt)
+    for kind, prompt in _SYSTEM_PROMPTS.items()
+}
+_GENERATE_CONFIGS["JOINT"].response_mime_type = "application/json"
+_GENERATE_CONFIGS["JOINT"].response_schema = DecisionPair
+
+
+def _enable_explicit_cache():
+    """Upload each system prompt once as cached content and reference it by name.
+
+    The model rejects prompts below its minimum cacheable size, in which case
+    that prompt keeps relying on implicit prefix caching.
+    """
+    for kind, prompt in _SYSTEM_PROMPTS.items():
+        try:
+            cache = client.caches.create(
+                model=CFG.model_name,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"echo-grid-{kind.lower()}",
+                    system_instruction=prompt,
+                    ttl=CFG.gemini_cache_ttl,
+                ),
+            )
+        except Exception as e:
+            print(f"⚠️ Explicit cache unavailable for {kind} prompt: {e}")
+            continue
+        _GENERATE_CONFIGS[kind] = _GENERATE_CONFIGS[kind].model_copy(
+            update={"system_instruction": None, "cached_content": cache.name}
+        )
 
-def _log_to_firebase(message: str, log_type: str = "info", agent: str = "system") -> None:
-    """Push console messages to Firebase in real-time."""
-    try:
-        timestamp = time.strftime("%H:%M:%S")
-        db.reference("/logs").push({
-            "timestamp": timestamp,
-            "agent": agent,
-            "type": log_type,
+# Caps in-flight Gemini requests (decisions + prefetch) so bursts don't trip the RPM quota
+_RATE = asyncio.Semaphore(CFG.gemini_max_concurrent)
+
+
+def _is_quota_error(error) -> bool:
+    error_msg = str(error)
+    return "429" in error_msg or "RESOURCE_EXHAUSTED" in error_msg
+
+
+async def _call_gemini(request):
+    """Await `request()` under the concurrency cap, backing off exponentially on 429s."""
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            async with _RATE:
+                return await request()
+        except Exception as e:
+            if attempt == GEMINI_MAX_RETRIES or not _is_quota_error(e):
+                raise
+        await asyncio.sleep(2 ** attempt)
+
+
+async def _generate(contents, kind="JOINT"):
+    return await _call_gemini(lambda: client.aio.models.generate_content(
+        model=CFG.model_name,
+        contents=contents,
+        config=_GENERATE_CONFIGS[kind],
+    ))
+
+
+# Streamed answers stop once the action and this much reasoning have arrived;
+# agent_log and the decision log never show more than that.
+STREAM_REASONING_CHARS = 200
+
+
+async def _generate_decision_text(contents, kind):
+    """Stream an "ACTION | REASONING" answer, closing the stream as soon as it is usable."""
+    async def request():
+        text = ""
+        stream = await client.aio.models.generate_content_stream(
+            model=CFG.model_name,
+            contents=contents,
+            config=_GENERATE_CONFIGS[kind],
+        )
+        async with aclosing(stream):
+            async for chunk in stream:
+                text += chunk.text or ""
+                _, sep, reasoning = text.partition("|")
+                if sep and len(reasoning) >= STREAM_REASONING_CHARS:
+                    break
+        return text
+
+    return await _call_gemini(request)
+
+# Per-call status block, filled with str.format_map in EnergyAgent.generate_prompt
+_STATUS_TEMPLATE = """
+          House: {name} ({role})
+          Current Time: {sim_time}
+
+          DATA:
+          - Grid Status: {grid_status} (Price: Rs {grid_price})
+          - Solar Output: {solar:.2f} kW
+          - House Load: {load:.2f} kW
+          - Battery: {battery}%
+          - Net Generation: {net_energy:.2f} kW (Positive=Excess, Negative=Deficit)
+          - Night Mode: {is_night}
+        """
+
+
+# --- FIREBASE REFERENCES ---
+# Every write is merged into a root multi-location update, so one reference
+# object is built once and reused instead of re-resolving paths per write.
+_ROOT_REF = db.reference("/")
+
+
+# --- LOG BUFFER ---
+# /logs entries are batched: callers append locally and the writer thread
+# uploads them with its next update, or at least every LOG_FLUSH_SECONDS.
+LOG_FLUSH_SECONDS = 5.0
+_LOG_BUFFER: deque = deque()  # (push_key, entry)
+
+_PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_sequence = itertools.count(random.getrandbits(60))
+
+
+def _next_push_key() -> str:
+    """Client-side Firebase push key: ms timestamp + sequence, so keys sort chronologically."""
+    now = int(time.time() * 1000)
+    seq = next(_push_sequence)
+    stamp = suffix = ""
+    for _ in range(8):
+        stamp = _PUSH_CHARS[now % 64] + stamp
+        now //= 64
+    for _ in range(12):
+        suffix = _PUSH_CHARS[seq % 64] + suffix
+        seq //= 64
+    return stamp + suffix
+
+
+_clock_cache = (None, "")  # (epoch second, "HH:MM:SS"), swapped atomically between threads
+
+
+def _clock_str(epoch: float = None) -> str:
+    """Local "HH:MM:SS" for `epoch` (default now), formatted at most once per second."""
+    global _clock_cache
+    second = int(time.time() if epoch is None else epoch)
+    cached_second, text = _clock_cache
+    if second != cached_second:
+        text = time.strftime("%H:%M:%S", time.localtime(second))
+        _clock_cache = (second, text)
+    return text
+
+
+def _buffer_log(entry: dict) -> None:
+    _LOG_BUFFER.append((_next_push_key(), entry))
+
+
+class _FirebaseLogHandler(logging.Handler):
+    """Queue each record for the batched /logs upload and print it."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        _buffer_log({
+            "timestamp": _clock_str(record.created),
+            "agent": getattr(record, "agent", "system"),
+            "type": getattr(record, "log_type", "info"),
             "message": message,
         })
         print(message)  # Also print to terminal
+
+
+# Messages are only %-formatted once a record passes CFG.log_level
+logger = logging.getLogger("echo_grid.agents")
+logger.setLevel(CFG.log_level)
+logger.addHandler(_FirebaseLogHandler())
+logger.propagate = False
+_LOG_LEVELS = {"error": logging.ERROR, "warning": logging.WARNING}
+
+
+def _log_to_firebase(message: str, log_type: str = "info", agent: str = "system", *args) -> None:
+    """Log to the terminal and /logs; `args` are %-formatted into `message` lazily."""
+    level = _LOG_LEVELS.get(log_type, logging.INFO)
+    if logger.isEnabledFor(level):
+        logger.log(level, message, *args, extra={"agent": agent, "log_type": log_type})
+
+
+# --- BACKGROUND WRITES ---
+# Local `state` is updated synchronously and is what the loop acts on; Firebase
+# only has to catch up. Writes are queued and one writer thread sends them in
+# order, merging whatever arrives within WRITE_BATCH_WAIT of each other (plus
+# any buffered logs) into a single root update.
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_WAIT = 0.05  # seconds
+_WRITE_QUEUE: queue.Queue = queue.Queue()  # (path, updates)
+
+
+def _path_ancestors(path: str) -> list:
+    parts = path.strip("/").split("/")
+    return ["/" + "/".join(parts[:i]) for i in range(1, len(parts))]
+
+
+def _send_update(merged: dict) -> None:
+    if not merged:
+        return
+    try:
+        _ROOT_REF.update(merged)
     except Exception as e:
-        print(f"[LOG ERROR] {e}")
-        print(message)  # Fallback: just print if Firebase fails
+        _log_to_firebase("❌ Failed to write to Firebase: %s", "error", "system", e)
+
+
+def _send_batch(batch: list) -> None:
+    """Merge queued (path, updates) writes into as few root updates as possible.
+
+    RTDB rejects an update that sets both a path and one of its descendants, so
+    the merged update is sent early whenever a later write would overlap it;
+    otherwise a later value simply replaces an earlier one for the same path.
+    """
+    while _LOG_BUFFER:
+        key, entry = _LOG_BUFFER.popleft()
+        batch.append(("/logs", {key: entry}))
+
+    merged, staged_ancestors = {}, set()
+    for path, updates in batch:
+        for key, value in updates.items():
+            full_path = "/" + f"{path.strip('/')}/{key.strip('/')}".strip("/")
+            ancestors = _path_ancestors(full_path)
+            if full_path in staged_ancestors or any(a in merged for a in ancestors):
+                _send_update(merged)
+                merged, staged_ancestors = {}, set()
+            merged[full_path] = value
+            staged_ancestors.update(ancestors)
+    _send_update(merged)
+
+
+def _writer_loop() -> None:
+    while True:
+        try:
+            batch = [_WRITE_QUEUE.get(timeout=LOG_FLUSH_SECONDS)]
+        except queue.Empty:
+            batch = []  # Nothing queued; still upload buffered logs
+        try:
+            while batch and len(batch) < WRITE_BATCH_SIZE:
+                batch.append(_WRITE_QUEUE.get(timeout=WRITE_BATCH_WAIT))
+        except queue.Empty:
+            pass
+        queued = len(batch)
+        try:
+            _send_batch(batch)
+        finally:
+            for _ in range(queued):
+                _WRITE_QUEUE.task_done()
+
+
+def _write_async(path: str, updates: dict) -> None:
+    """Queue db.reference(path).update(updates) without waiting for the server ACK."""
+    _WRITE_QUEUE.put((path, updates))
+
+
+# The pending end of the A_TO_B LED pulse. A tick that flushes before its timer
+# fires sends it first, under its own values, so the stale pulse end cannot
+# land after (and overwrite) a newer tick.
+_PULSE_LOCK = threading.Lock()
+_pulse_timer = None
+_pulse_updates: dict = {}
+
+
+def _take_pulse_end() -> dict:
+    """Cancel the pending pulse-end write and return its paths. Call with _PULSE_LOCK held."""
+    global _pulse_timer, _pulse_updates
+    if _pulse_timer is not None:
+        _pulse_timer.cancel()
+    updates, _pulse_timer, _pulse_updates = _pulse_updates, None, {}
+    return updates
+
+
+def _send_pulse_end() -> None:
+    with _PULSE_LOCK:
+        updates = _take_pulse_end()
+        if updates:
+            _write_async("/", updates)
+
+
+def _write_pulse_end(delay: float, updates: dict) -> None:
+    """Queue the pulse-end write after `delay` seconds. Call with _PULSE_LOCK held."""
+    global _pulse_timer, _pulse_updates
+    _pulse_updates = dict(updates)
+    _pulse_timer = threading.Timer(delay, _send_pulse_end)
+    _pulse_timer.start()
+
+
+def _wait_for_writes() -> None:
+    """Block until every queued write has reached Firebase."""
+    _WRITE_QUEUE.join()
+
+
+def _flush_writes() -> None:
+    """Send queued writes and buffered logs before the process exits."""
+    _write_async("/", {})  # Wakes the writer so it drains the log buffer too
+    _wait_for_writes()
+
+
+threading.Thread(target=_writer_loop, name="firebase-writer", daemon=True).start()
+atexit.register(_flush_writes)
+
+
+class PendingWrites:
+    """Firebase mutations for one tick, sent as a single root multi-location update.
+
+    Paths are full RTDB paths ("/house_a/wallet_balance"); staging the same path
+    twice keeps the later value, as sequential writes would. `later` holds the
+    paths that land PULSE_SECONDS after the tick (end of the A_TO_B LED pulse),
+    or with the next tick's update if that flushes first.
+    """
+
+    PULSE_SECONDS = 1.0
+
+    def __init__(self):
+        self.updates = {}
+        self.later = {}
+
+    def update(self, updates: dict) -> None:
+        self.updates.update(updates)
+
+    def flush(self, state=None) -> None:
+        """Queue the tick's update; with `state`, also mirror it (pulse end included) locally."""
+        if state is not None:
+            for path, value in itertools.chain(self.updates.items(), self.later.items()):
+                apply_update(state, path, value)
+        # The writer thread adds logs queued during the tick to the same update
+        with _PULSE_LOCK:
+            updates = {**_take_pulse_end(), **self.updates}
+            if updates:
+                _write_async("/", updates)
+            if self.later:
+                _write_pulse_end(self.PULSE_SECONDS, self.later)
+        self.updates, self.later = {}, {}
+
 
+# LED mode for the grid-supply action codes present (3 = GRID_TO_A, 4 = GRID_TO_B)
+_GRID_LED_MODES = {
+    frozenset({3, 4}): "GRID_TO_BOTH",
+    frozenset({3}): "GRID_TO_A",
+    frozenset({4}): "GRID_TO_B",
+}
 
-def _write_actions_to_firebase(active_actions: list) -> None:
-    """Write multiple active action codes to Firebase for ESP consumption.
+
+def _action_updates(active_actions: list) -> dict:
+    """Build the multi-location /controls update for ESP consumption.
     active_actions: list of dicts with keys: code, label, reason
     """
-    try:
-        actions_dict = {}
-        action_codes = []
-        labels = []
-        reasons = []
-        
-        for action in active_actions:
-            actions_dict[f"action_{action['code']}"] = True
-            action_codes.append(action['code'])
-            labels.append(action['label'])
-            reasons.append(action['reason'])
-        
-        # Set all actions to false first, then enable active ones
-        db.reference("/controls").update({
-            "action_1": False,  # A_TO_B
-            "action_2": False,  # A_TO_MASJID
-            "action_3": False,  # GRID_TO_A
-            "action_4": False,  # GRID_TO_B
-        })
-        
-        db.reference("/controls").update({
-            **actions_dict,
-            "active_codes": action_codes,
-            "labels": ", ".join(labels),
-            "reasons": " | ".join(reasons),
-            "timestamp": time.strftime("%H:%M:%S"),
-        })
-    except Exception as e:
-        _log_to_firebase(f"❌ Failed to update controls: {e}", "error", "system")
+    # Every action starts false; the active ones are switched on below
+    updates = {
+        "/controls/action_1": False,  # A_TO_B
+        "/controls/action_2": False,  # A_TO_MASJID
+        "/controls/action_3": False,  # GRID_TO_A
+        "/controls/action_4": False,  # GRID_TO_B
+    }
+    for action in active_actions:
+        updates[f"/controls/action_{action['code']}"] = True
+
+    updates["/controls/active_codes"] = [action['code'] for action in active_actions]
+    updates["/controls/labels"] = ", ".join(action['label'] for action in active_actions)
+    updates["/controls/reasons"] = " | ".join(action['reason'] for action in active_actions)
+    updates["/controls/timestamp"] = _clock_str()
+    return updates
+
+
+def _rule_based_decision(world_state, name, role):
+    """Evaluate the unambiguous STRICT RULES locally.
+
+    Returns (action, reasoning) when a rule clearly applies, or None when the
+    state is ambiguous and should be handed to Gemini.
+    """
+    grid = world_state['grid']
+    grid_price = grid.get("price", grid.get("price_per_unit", 0))
+    grid_online = grid.get("status", "ONLINE") == "ONLINE"
+    me = world_state[name]
+    sim_time = world_state['simulation'].get('clock', '12:00')
+
+    solar = me.get('solar_output', me.get('solar_input', 0))
+    net_energy = solar - me.get('current_load', 0)
+    battery = me.get('battery_level', 50)
+
+    # 4. Charity window (15:00-16:00 with solar)
+    if sim_time.split(":")[0] == "15" and solar >= 0.1:
+        return "DONATE_MASJID", "rule:charity_window"
+
+    # 3. Buyer mode: low battery and a deficit to cover
+    if role == "CONSUMER" and battery < 30 and net_energy < 0:
+        return "BUY_P2P", "rule:buyer_low_battery"
+
+    # 1. Night mode: never sell
+    if solar < 0.1:
+        if battery >= 40:
+            return "HOLD", "rule:night_battery_ok"
+        if grid_online and grid_price < 30:
+            return "CHARGE_FROM_GRID", "rule:night_cheap_grid"
+        return None
+
+    # 2. Day mode with a clear surplus
+    if solar > 0.5 and net_energy > 1.0:
+        if grid_price > 40:
+            return "OFFER_P2P", "rule:day_surplus_expensive_grid"
+        if grid_price < 30:
+            return "CHARGE_BATTERY", "rule:day_surplus_cheap_grid"
+
+    return None
+
+
+# Decision log line per action: (emoji, label padded to the column width)
+_ACTION_FMT = {
+    "OFFER_P2P": ("🟢", "SELLING "),
+    "CHARGE_FROM_GRID": ("🔌", "CHARGING"),
+    "DONATE_MASJID": ("🕌", "CHARITY "),
+    "CHARGE_BATTERY": ("🔋", "STORING "),
+}
 
 
 class EnergyAgent:
@@ -107,176 +628,228 @@ class EnergyAgent:
         """AI-driven price calculation for P2P selling/buying with mutual profit."""
         grid = world_state['grid']
         grid_price = grid.get("price_per_unit", WAPDA_OFFPEAK_PRICE)
-        grid_status = grid.get("status", "ONLINE")
-        is_peak = grid_price >= 46.0
-        
+
         # WAPDA reference price (what grid charges)
         wapda_ref = grid_price  # Use actual grid price instead of hardcoded peak/offpeak
-        
-        if self.role == "PRODUCER":
-            # Seller wants profit while keeping buyer profitable
-            # Buyer pays: seller_price + transmission_rent
-            # For buyer to profit (save money vs WAPDA):
-            #   seller_price + transmission_rent < WAPDA_ref - minimum_savings
-            
-            minimum_buyer_savings = 1.0  # At least 1 rupee profit for buyer (reduced)
-            max_seller_price = wapda_ref - TRANSMISSION_RENT_PER_UNIT - minimum_buyer_savings
-            
-            # Seller wants profit > generation cost
-            min_seller_price = WAPDA_GENERATION_COST + 1.0  # At least 1 rupee profit (reduced)
-            
-            # Seller's bid: take the average of min and max, leaning toward lower to close deals
-            seller_bid = round((min_seller_price * 2 + max_seller_price) / 3.0, 1)
-            seller_bid = min(seller_bid, max_seller_price)
-            seller_bid = max(seller_bid, min_seller_price)
-            
-            return seller_bid
-        
-        else:
-            # Buyer wants to maximize savings while offering fair price
-            # Buyer's total cost: seller_price + transmission_rent
-            # Buyer saves if: seller_price + transmission_rent < WAPDA_ref
-            
-            # Buyer is willing to pay up to WAPDA - 0.5 rupee savings minimum
-            max_buyer_bid = wapda_ref - TRANSMISSION_RENT_PER_UNIT - 0.5
-            
-            # Buyer wants to pay minimum, but not less than generation cost
-            # (to be fair to seller, at least seller breaks even)
-            min_buyer_bid = WAPDA_GENERATION_COST + 0.5
-            
-            # Buyer's bid: average, leaning toward max to ensure deal happens
-            buyer_bid = round((min_buyer_bid + max_buyer_bid * 2) / 3.0, 1)
-            buyer_bid = min(buyer_bid, max_buyer_bid)
-            buyer_bid = max(buyer_bid, min_buyer_bid)
-            
-            return buyer_bid
+
+        target, lowest, highest = _bid_bounds(float(wapda_ref), self.role == "PRODUCER")
+        return max(min(round(target, 1), highest), lowest)
 
     def generate_prompt(self, world_state):
         grid = world_state['grid']
-        grid_price = grid.get("price", grid.get("price_per_unit", 0))
-        grid_status = grid.get("status", "ONLINE")
         me = world_state[self.name]
-        sim_time = world_state['simulation'].get('clock', '12:00')
 
-          # Calculate Net Energy (Solar - Load)
+        # Calculate Net Energy (Solar - Load)
         solar = me.get('solar_output', me.get('solar_input', 0))
         load = me.get('current_load', 0)
-        net_energy = solar - load
-        battery = me.get('battery_level', 50)
-        is_night = solar < 0.1
-        
-        system_instruction = f"""
-          You are the Smart Energy Agent for {self.name} ({self.role}) in Pakistan.
-        Current Time: {sim_time}
-        
-          DATA:
-          - Grid Status: {grid_status} (Price: Rs {grid_price})
-          - Solar Output: {solar:.2f} kW
-          - House Load: {load:.2f} kW
-          - Battery: {battery}%
-          - Net Generation: {net_energy:.2f} kW (Positive=Excess, Negative=Deficit)
-          - Night Mode: {is_night}
+        return _STATUS_TEMPLATE.format_map({
+            "name": self.name,
+            "role": self.role,
+            "sim_time": world_state['simulation'].get('clock', '12:00'),
+            "grid_status": grid.get("status", "ONLINE"),
+            "grid_price": grid.get("price", grid.get("price_per_unit", 0)),
+            "solar": solar,
+            "load": load,
+            "battery": me.get('battery_level', 50),
+            "net_energy": solar - load,
+            "is_night": solar < 0.1,
+        })
 
-          *** CRITICAL CONSTRAINT ***
-          NEVER EVER sell (OFFER_P2P or SELL_TO_GRID) when Solar Output < 0.1 kW.
-          At night, you have NO SOLAR to sell. Period.
-          
-          STRICT RULES:
-          1. NIGHT MODE (Solar < 0.1): MUST NOT sell. You are consuming.
-              - Only actions: "CHARGE_FROM_GRID", "HOLD", "BUY_P2P"
-              - If Battery < 40% and Price is Cheap -> ACTION: "CHARGE_FROM_GRID"
-              - If Battery is fine -> ACTION: "HOLD"
-              - NEVER OFFER_P2P or SELL_TO_GRID at night.
-
-          2. DAY MODE (Solar > 0.5): You have solar generation.
-              - If Net Generation > 1.0 AND Grid is Expensive (>40) -> ACTION: "OFFER_P2P" (Only action for selling)
-              - If Net Generation > 1.0 AND Grid is Cheap (<30) -> ACTION: "CHARGE_BATTERY" (Store it).
-              - If Battery Low -> ACTION: "CHARGE_FROM_GRID"
-              - Else -> ACTION: "HOLD"
-
-          3. BUYER MODE (If needed): Only "BUY_P2P" when Battery < 30% and need power.
-
-          4. CHARITY WINDOW (15:00-16:00 with Solar): Only "DONATE_MASJID".
-
-          DECISION FORMAT:
-          Return exactly: "ACTION | REASONING"
-          Allowed Actions: "HOLD", "CHARGE_FROM_GRID", "CHARGE_BATTERY", "SELL_TO_GRID", "OFFER_P2P", "BUY_P2P", "DONATE_MASJID"
-        """
-        return system_instruction
+    def _mock_decision(self):
+        # Canned responses to avoid API quota
+        if self.role == "PRODUCER":
+            return "OFFER_P2P", "Battery high, offering P2P trade"
+        return "BUY_P2P", "Battery low, seeking P2P purchase"
 
-    def reason_and_act(self, world_state):
-        prompt = self.generate_prompt(world_state)
-        try:
-            if USE_MOCK:
-                # Use mock responses to avoid API quota
-                if self.role == "PRODUCER":
-                    action = "OFFER_P2P"
-                    reasoning = "Battery high, offering P2P trade"
-                else:
-                    action = "BUY_P2P"
-                    reasoning = "Battery low, seeking P2P purchase"
-            else:
-                response = client.models.generate_content(
-                    model=MODEL_NAME,
-                    contents=prompt,
-                )
-                raw_output = (response.text or "").strip()
-                if "|" in raw_output:
-                    action, reasoning = raw_output.split("|", 1)
-                else:
-                    action = "HOLD"
-                    reasoning = raw_output
-
-            action = action.strip()
-            reasoning = reasoning.strip()
-
-            # Update Log
-            if action == "OFFER_P2P":
-                _log_to_firebase(f"🟢 {self.name}: SELLING  | {reasoning[:50]}...", "decision", self.name)
-            elif action == "CHARGE_FROM_GRID":
-                _log_to_firebase(f"🔌 {self.name}: CHARGING | {reasoning[:50]}...", "decision", self.name)
-            elif action == "DONATE_MASJID":
-                _log_to_firebase(f"🕌 {self.name}: CHARITY  | {reasoning[:50]}...", "decision", self.name)
-            elif action == "CHARGE_BATTERY":
-                _log_to_firebase(f"🔋 {self.name}: STORING  | {reasoning[:50]}...", "decision", self.name)
-            else:
-                _log_to_firebase(f"⚪ {self.name}: {action}     | {reasoning[:50]}...", "decision", self.name)
-            db.reference(f'/{self.name}').update({
+    def _state_key(self, world_state):
+        grid = world_state['grid']
+        me = world_state[self.name]
+        solar = me.get('solar_output', me.get('solar_input', 0))
+        sim_time = world_state['simulation'].get('clock', '12:00')
+        return (
+            self.role,
+            grid.get("status", "ONLINE"),
+            round(grid.get("price", grid.get("price_per_unit", 0))),
+            round(solar, 1),
+            round(me.get('current_load', 0), 1),
+            round(me.get('battery_level', 50), -1),
+            solar < 0.1,
+            sim_time.split(":")[0] == "15",  # charity window
+        )
+
+    def _local_decision(self, world_state):
+        """Return (action, reasoning) without an API call, or None if Gemini must decide."""
+        return _rule_based_decision(world_state, self.name, self.role) or _cache_get(self._state_key(world_state))
+
+    async def _ask_gemini(self, prompt, key):
+        raw_output = await _generate_decision_text(prompt, self.role)
+        decision = _parse_decision(raw_output)
+        if decision is None:
+            # Malformed or blocked (empty) replies are acted on as HOLD but never cached
+            return "HOLD", (raw_output or "").strip()
+        _cache_put(key, decision)
+        return decision
+
+    def _record_decision(self, action, reasoning, pending=None):
+        action = action.strip()
+        reasoning = reasoning.strip()
+
+        # Update Log
+        emoji, label = _ACTION_FMT.get(action) or ("⚪", action + "    ")
+        _log_to_firebase("%s %s: %s | %.50s...", "decision", self.name, emoji, self.name, label, reasoning)
+        if pending is None:
+            _write_async(f'/{self.name}', {
                 "agent_log": reasoning,
                 "last_action": action
             })
-            db.reference("/logs").push({
-                "timestamp": time.strftime("%H:%M:%S"),
-                "agent": self.name,
-                "action": action,
-                "message": reasoning,
+        else:
+            pending.update({
+                f"/{self.name}/agent_log": reasoning,
+                f"/{self.name}/last_action": action,
             })
-            return action
+        _buffer_log({
+            "timestamp": _clock_str(),
+            "agent": self.name,
+            "action": action,
+            "message": reasoning,
+        })
+        return action
+
+    def _fallback_action(self, error):
+        global _quota_fallbacks
+        if _is_quota_error(error):
+            _quota_fallbacks += 1
+            _log_to_firebase("⚠️ Quota exhausted after retries. Using fallback mock response.", "warning", self.name)
+            # Return mock response on quota error
+            return self._mock_decision()[0]
+        else:
+            _log_to_firebase("❌ Error: %s", "error", self.name, error)
+            return "HOLD"
+
+
+# Agents hold no per-tick state, so one instance per house serves every loop
+AGENT_A = EnergyAgent("house_a", "PRODUCER")
+AGENT_B = EnergyAgent("house_b", "CONSUMER")
+AGENTS = (AGENT_A, AGENT_B)
+
+
+def _parse_decision(raw_output):
+    """(action, reasoning) from an "ACTION | REASONING" reply, or None unless ACTION is a known action."""
+    action, sep, reasoning = (raw_output or "").strip().partition("|")
+    action = action.strip()
+    if not sep or action not in _ACTIONS:
+        return None
+    return action, reasoning.strip()
+
+
+def generate_joint_prompt(prompts_by_house):
+    """Combine several agents' status blocks into one request (answered as a DecisionPair)."""
+    houses = ", ".join(prompts_by_house)
+    return (
+        "Decide for EACH house below independently, using the same rules.\n"
+        "Instead of the \"ACTION | REASONING\" line, return a JSON object with one "
+        f"{{\"action\", \"reasoning\"}} decision per house (houses: {houses}).\n"
+        + "\n".join(prompts_by_house.values())
+    )
+
+
+async def _decide_jointly(agents, world_state):
+    """Return (decisions, error) for all agents using at most one Gemini request, without recording them."""
+    decisions = [agent._local_decision(world_state) for agent in agents]
+    undecided = [i for i, decision in enumerate(decisions) if decision is None]
+    # Prompts are only needed for houses that rules and cache could not settle
+    prompts = {i: agents[i].generate_prompt(world_state) for i in undecided}
+
+    error = None
+    try:
+        if len(undecided) == 1:
+            i = undecided[0]
+            decisions[i] = await agents[i]._ask_gemini(prompts[i], agents[i]._state_key(world_state))
+        elif undecided:
+            joint_prompt = generate_joint_prompt({agents[i].name: prompts[i] for i in undecided})
+            response = await _generate(joint_prompt)
+            answers = response.parsed
+            if answers is None:
+                # Invalid or blocked JSON: every undecided house takes the error fallback, nothing is cached
+                raise ValueError("Gemini returned no parseable DecisionPair")
+            for i in undecided:
+                answer = getattr(answers, agents[i].name)
+                decisions[i] = (answer.action, answer.reasoning)
+                _cache_put(agents[i]._state_key(world_state), decisions[i])
+    except Exception as e:
+        error = e
+    return decisions, error
+
+
+async def reason_and_act_jointly(agents, world_state, pending=None):
+    """Decide for all agents with at most one Gemini request; returns their actions in order."""
+    if CFG.use_mock:
+        return [agent._record_decision(*agent._mock_decision(), pending) for agent in agents]
+    decisions, error = await _decide_jointly(agents, world_state)
+
+    actions = []
+    for agent, decision in zip(agents, decisions):
+        try:
+            if decision is None:
+                raise error
+            actions.append(agent._record_decision(*decision, pending))
         except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "RESOURCE_EXHAUSTED" in error_msg:
-                _log_to_firebase(f"⚠️ Quota exhausted. Using fallback mock response.", "warning", self.name)
-                # Return mock response on quota error
-                if self.role == "PRODUCER":
-                    return "OFFER_P2P"
-                else:
-                    return "BUY_P2P"
-            else:
-                _log_to_firebase(f"❌ Error: {e}", "error", self.name)
-                return "HOLD"
+            actions.append(agent._fallback_action(e))
+    return actions
+
+
+async def _prefetch_decisions(agents, world_state, next_index, sim):
+    """Warm the decision cache for the next step while the current one sleeps.
+
+    The next state is predicted from the CSV row and battery dynamics only, so a
+    wrong guess (e.g. after a P2P trade in between) just costs one wasted request.
+    """
+    state = {key: dict(world_state.get(key) or {}) for key in ("grid", "simulation", *_HOUSE_KEYS)}
+    _update_world_from_index(next_index, sim, state)
+    _apply_battery_dynamics(state)
+    await _decide_jointly(agents, state)
+
+
+# --- PRICING MATH ---
 
 def _clamp(value, min_value, max_value):
     return max(min_value, min(max_value, value))
 
 
-def _battery_delta_percent(net_kw, step_minutes):
-    step_hours = step_minutes / 60.0
-    delta_kwh = net_kw * step_hours
-    return (delta_kwh / BATTERY_CAPACITY_KWH) * 100.0
+def _bid_bounds(wapda_ref, is_producer):
+    """(target, lowest, highest) P2P bid per unit for the seller or the buyer."""
+    if is_producer:
+        # Seller wants profit while keeping buyer profitable
+        # Buyer pays: seller_price + transmission_rent
+        # For buyer to profit (save money vs WAPDA):
+        #   seller_price + transmission_rent < WAPDA_ref - minimum_savings
+        minimum_buyer_savings = 1.0  # At least 1 rupee profit for buyer (reduced)
+        max_seller_price = wapda_ref - TRANSMISSION_RENT_PER_UNIT - minimum_buyer_savings
 
+        # Seller wants profit > generation cost
+        min_seller_price = WAPDA_GENERATION_COST + 1.0  # At least 1 rupee profit (reduced)
 
-def _negotiate_p2p_price(grid_price, grid_status, seller_battery, buyer_battery):
-    if grid_status == "ONLINE":
+        # Seller's bid: take the average of min and max, leaning toward lower to close deals
+        return (min_seller_price * 2 + max_seller_price) / 3.0, min_seller_price, max_seller_price
+
+    # Buyer wants to maximize savings while offering fair price
+    # Buyer's total cost: seller_price + transmission_rent
+    # Buyer saves if: seller_price + transmission_rent < WAPDA_ref
+
+    # Buyer is willing to pay up to WAPDA - 0.5 rupee savings minimum
+    max_buyer_bid = wapda_ref - TRANSMISSION_RENT_PER_UNIT - 0.5
+
+    # Buyer wants to pay minimum, but not less than generation cost
+    # (to be fair to seller, at least seller breaks even)
+    min_buyer_bid = WAPDA_GENERATION_COST + 0.5
+
+    # Buyer's bid: average, leaning toward max to ensure deal happens
+    return (min_buyer_bid + max_buyer_bid * 2) / 3.0, min_buyer_bid, max_buyer_bid
+
+
+def _p2p_price_bounds(grid_price, grid_online, seller_battery, buyer_battery):
+    """(seller_floor, buyer_ceiling) for the battery-aware P2P price."""
+    if grid_online:
         base = grid_price
     else:
         base = max(grid_price, 70.0)
@@ -285,10 +858,16 @@ def _negotiate_p2p_price(grid_price, grid_status, seller_battery, buyer_battery)
     if seller_battery < 40:
         seller_floor += (40 - seller_battery) * 0.4
 
-    buyer_ceiling = base * (0.95 if grid_status == "ONLINE" else 1.15)
+    buyer_ceiling = base * (0.95 if grid_online else 1.15)
     if buyer_battery < 30:
         buyer_ceiling += (30 - buyer_battery) * 0.6
+    return seller_floor, buyer_ceiling
 
+
+def _negotiate_p2p_price(grid_price, grid_status, seller_battery, buyer_battery):
+    seller_floor, buyer_ceiling = _p2p_price_bounds(
+        float(grid_price), grid_status == "ONLINE", float(seller_battery), float(buyer_battery)
+    )
     if buyer_ceiling < seller_floor:
         return None
 
@@ -296,24 +875,53 @@ def _negotiate_p2p_price(grid_price, grid_status, seller_battery, buyer_battery)
     return round(price, 1)
 
 
-def _load_simulation_rows(path):
+_SIM_DTYPES = {
+    "timestamp": "str",
+    "grid_status": "str",
+    "grid_price": "float64",
+    "house_a_solar": "float64",
+    "house_a_load": "float64",
+    "house_b_solar": "float64",
+    "house_b_load": "float64",
+}
+
+
+def _load_simulation_arrays(path):
+    """Parse the dataset once into typed column arrays (struct-of-arrays), indexed by row.
+
+    "text" keeps every column's cells as read, which /simulation/current_row publishes.
+    """
     if not os.path.exists(path):
         raise FileNotFoundError(f"Simulation dataset not found: {path}")
 
-    with open(path, "r", encoding="utf-8") as csv_file:
-        reader = csv.DictReader(csv_file)
-        return list(reader)
+    # Only the typed columns are parsed (peak_period is unused), with the C parser over a memory map
+    frame = pd.read_csv(path, usecols=list(_SIM_DTYPES), dtype=str, keep_default_na=False,
+                        engine="c", memory_map=True)
+    grid_status = frame["grid_status"].str.strip().str.upper()
+    return {
+        "timestamp": frame["timestamp"].str.strip().to_numpy(dtype=object),
+        "grid_status": grid_status.to_numpy(dtype=object),
+        "grid_online": (grid_status == "ON").to_numpy(dtype=np.bool_),
+        "grid_price": frame["grid_price"].astype(_SIM_DTYPES["grid_price"]).to_numpy(),
+        "house_a_solar": frame["house_a_solar"].astype(_SIM_DTYPES["house_a_solar"]).to_numpy(),
+        "house_a_load": frame["house_a_load"].astype(_SIM_DTYPES["house_a_load"]).to_numpy(),
+        "house_b_solar": frame["house_b_solar"].astype(_SIM_DTYPES["house_b_solar"]).to_numpy(),
+        "house_b_load": frame["house_b_load"].astype(_SIM_DTYPES["house_b_load"]).to_numpy(),
+        "text": {column: frame[column].to_numpy(dtype=object) for column in _SIM_DTYPES},
+    }
 
 
-def _update_world_from_row(row, state):
-    grid_status = "ONLINE" if row["grid_status"].strip().upper() == "ON" else "BLACKOUT"
-    grid_price = float(row["grid_price"])
+def _update_world_from_index(i, sim, state):
+    # float()/bool() keep numpy scalars out of the state and the Firebase payload
+    grid_status = "ONLINE" if bool(sim["grid_online"][i]) else "BLACKOUT"
+    grid_price = float(sim["grid_price"][i])
     voltage = 220 if grid_status == "ONLINE" else 0
+    timestamp = sim["timestamp"][i]
 
-    house_a_solar = float(row["house_a_solar"])
-    house_a_load = float(row["house_a_load"])
-    house_b_solar = float(row["house_b_solar"])
-    house_b_load = float(row["house_b_load"])
+    house_a_solar = float(sim["house_a_solar"][i])
+    house_a_load = float(sim["house_a_load"][i])
+    house_b_solar = float(sim["house_b_solar"][i])
+    house_b_load = float(sim["house_b_load"][i])
 
     updates = {
         "/grid/status": grid_status,
@@ -323,7 +931,12 @@ def _update_world_from_row(row, state):
         "/house_a/current_load": house_a_load,
         "/house_b/solar_output": house_b_solar,
         "/house_b/current_load": house_b_load,
-        "/simulation/clock": row["timestamp"].strip(),
+        "/simulation/clock": timestamp,
+        # Unparsed CSV cells, exactly as the file has them
+        "/simulation/current_row": {
+            **{column: cells[i] for column, cells in sim["text"].items()},
+            "index": i,
+        },
     }
 
     state["grid"]["status"] = grid_status
@@ -333,72 +946,75 @@ def _update_world_from_row(row, state):
     state["house_a"]["current_load"] = house_a_load
     state["house_b"]["solar_output"] = house_b_solar
     state["house_b"]["current_load"] = house_b_load
-    state["simulation"]["clock"] = row["timestamp"].strip()
+    state["simulation"]["clock"] = timestamp
 
     return updates
 
 
+_HOUSE_KEYS = ("house_a", "house_b")
+
+
 def _apply_battery_dynamics(state):
+    """Advance every house battery by one step as a single vectorised update."""
+    houses = [state[house_key] for house_key in _HOUSE_KEYS]
+    solar = np.array([house.get("solar_output", 0) for house in houses], dtype=np.float64)
+    load = np.array([house.get("current_load", 0) for house in houses], dtype=np.float64)
+    levels = np.array([house.get("battery_level", 50) for house in houses], dtype=np.float64)
+
+    levels = np.clip(levels + (solar - load) * _BATT_KW_TO_PCT, 0, 100)
+
     updates = {}
-    for house_key in ("house_a", "house_b"):
-        house = state[house_key]
-        net_kw = house.get("solar_output", 0) - house.get("current_load", 0)
-        delta_percent = _battery_delta_percent(net_kw, STEP_MINUTES)
-        new_level = _clamp(house.get("battery_level", 50) + delta_percent, 0, 100)
+    for house_key, house, new_level in zip(_HOUSE_KEYS, houses, levels.tolist()):
         house["battery_level"] = new_level
         updates[f"/{house_key}/battery_level"] = new_level
 
     return updates
 
 
-def _apply_grid_action(state, house_key, action):
+def _settle_house(state, house_key, wallet_delta, battery_delta_pct, updates):
+    """Apply a wallet/battery change to local state and stage the matching Firebase paths."""
+    house = state[house_key]
+    house["wallet_balance"] = house.get("wallet_balance", 0) + wallet_delta
+    house["battery_level"] = _clamp(house.get("battery_level", 50) + battery_delta_pct, 0, 100)
+    updates[f"/{house_key}/wallet_balance"] = house["wallet_balance"]
+    updates[f"/{house_key}/battery_level"] = house["battery_level"]
+
+
+def _apply_grid_action(state, house_key, action, pending):
     grid = state["grid"]
     if grid.get("status") != "ONLINE":
         return
 
     grid_price = grid.get("price_per_unit", 0)
-    house = state[house_key]
-    wallet = house.get("wallet_balance", 0)
-
+    amount = grid_price * CFG.grid_charge_kwh
+    updates = {}
     if action == "CHARGE_FROM_GRID":
-        cost = grid_price * GRID_CHARGE_KWH
-        house["wallet_balance"] = wallet - cost
-        db.reference(f"/{house_key}/wallet_balance").set(house["wallet_balance"])
-        house["battery_level"] = _clamp(house.get("battery_level", 50) + (GRID_CHARGE_KWH / BATTERY_CAPACITY_KWH) * 100, 0, 100)
-        db.reference(f"/{house_key}/battery_level").set(house["battery_level"])
+        _settle_house(state, house_key, -amount, _GRID_CHARGE_PCT, updates)
     elif action == "SELL_TO_GRID":
-        revenue = grid_price * GRID_CHARGE_KWH
-        house["wallet_balance"] = wallet + revenue
-        db.reference(f"/{house_key}/wallet_balance").set(house["wallet_balance"])
-        house["battery_level"] = _clamp(house.get("battery_level", 50) - (GRID_CHARGE_KWH / BATTERY_CAPACITY_KWH) * 100, 0, 100)
-        db.reference(f"/{house_key}/battery_level").set(house["battery_level"])
-
-
-def _execute_p2p_trade(state, price):
-    house_a = state["house_a"]
-    house_b = state["house_b"]
-
-    total_cost = price * P2P_TRADE_KWH
-    house_a["wallet_balance"] = house_a.get("wallet_balance", 0) + total_cost
-    house_b["wallet_balance"] = house_b.get("wallet_balance", 0) - total_cost
-    db.reference("/house_a/wallet_balance").set(house_a["wallet_balance"])
-    db.reference("/house_b/wallet_balance").set(house_b["wallet_balance"])
-
-    battery_delta = (P2P_TRADE_KWH / BATTERY_CAPACITY_KWH) * 100
-    house_a["battery_level"] = _clamp(house_a.get("battery_level", 50) - battery_delta, 0, 100)
-    house_b["battery_level"] = _clamp(house_b.get("battery_level", 50) + battery_delta, 0, 100)
-    db.reference("/house_a/battery_level").set(house_a["battery_level"])
-    db.reference("/house_b/battery_level").set(house_b["battery_level"])
-
-    db.reference("/market").update({
-        "active_contract": True,
-        "transaction_price": price,
-        "latest_transaction": f"P2P DEAL: Rs {price}/kWh for {P2P_TRADE_KWH} kWh",
+        _settle_house(state, house_key, amount, -_GRID_CHARGE_PCT, updates)
+    else:
+        return
+
+    pending.update(updates)
+
+
+def _execute_p2p_trade(state, price, pending):
+    total_cost = price * CFG.p2p_trade_kwh
+    updates = {
+        "/market/active_contract": True,
+        "/market/transaction_price": price,
+        "/market/latest_transaction": f"P2P DEAL: Rs {price}/kWh for {CFG.p2p_trade_kwh} kWh",
+        "/visuals/led_mode": "A_TO_B",
+    }
+    _settle_house(state, "house_a", total_cost, -_P2P_DELTA_PCT, updates)
+    _settle_house(state, "house_b", -total_cost, _P2P_DELTA_PCT, updates)
+    pending.update(updates)
+
+    # Hold the A_TO_B LED pulse for a second, then go back to IDLE
+    pending.later.update({
+        "/market/active_contract": False,
+        "/visuals/led_mode": "IDLE",
     })
-    db.reference("/visuals").update({"led_mode": "A_TO_B"})
-    time.sleep(1)
-    db.reference("/market").update({"active_contract": False})
-    db.reference("/visuals").update({"led_mode": "IDLE"})
 
 
 def _calculate_power_flow(state):
@@ -432,7 +1048,7 @@ def _negotiate_p2p_deal(state, agent_a, agent_b, trade_amount):
     
     # Check if deal is possible (buyer willing to pay at least seller's minimum)
     if buyer_bid < seller_bid:
-        _log_to_firebase(f"❌ NO P2P DEAL: Seller wants Rs {seller_bid}/unit, Buyer offers Rs {buyer_bid}/unit (no overlap)", "negotiation_failed", "market")
+        _log_to_firebase("❌ NO P2P DEAL: Seller wants Rs %s/unit, Buyer offers Rs %s/unit (no overlap)", "negotiation_failed", "market", seller_bid, buyer_bid)
         return None
     
     # Negotiate: meet in the middle
@@ -449,11 +1065,11 @@ def _negotiate_p2p_deal(state, agent_a, agent_b, trade_amount):
     
     # Validate profitability (allow zero or small negative for buyer to enable trades)
     if seller_profit_per_unit < -0.5:
-        _log_to_firebase(f"❌ NO DEAL: Seller would lose Rs {abs(seller_profit_per_unit):.1f}/unit at price Rs {agreed_price}", "negotiation_failed", "market")
+        _log_to_firebase("❌ NO DEAL: Seller would lose Rs %.1f/unit at price Rs %s", "negotiation_failed", "market", abs(seller_profit_per_unit), agreed_price)
         return None
     
     if buyer_savings_per_unit < -2.0:  # Allow small loss for buyer if grid price is close
-        _log_to_firebase(f"❌ NO DEAL: Buyer would lose Rs {abs(buyer_savings_per_unit):.1f}/unit at price Rs {buyer_total_with_rent} (WAPDA: Rs {wapda_ref})", "negotiation_failed", "market")
+        _log_to_firebase("❌ NO DEAL: Buyer would lose Rs %.1f/unit at price Rs %s (WAPDA: Rs %s)", "negotiation_failed", "market", abs(buyer_savings_per_unit), buyer_total_with_rent, wapda_ref)
         return None
     
     # Successful negotiation!
@@ -473,7 +1089,7 @@ def _negotiate_p2p_deal(state, agent_a, agent_b, trade_amount):
     return deal
 
 
-def _process_negotiation(state, act_a, act_b):
+def _process_negotiation(state, act_a, act_b, pending):
     grid_status = state["grid"].get("status", "ONLINE")
     grid_price = state["grid"].get("price_per_unit", 0)
     battery_a = state["house_a"].get("battery_level", 50)
@@ -485,6 +1101,7 @@ def _process_negotiation(state, act_a, act_b):
 
     active_actions = []  # Track all simultaneous actions
     p2p_trade_happened = False  # Track if P2P trade occurred
+    updates = {}  # Staged into `pending` after the trade block's own paths
 
     # --- AUTOMATIC POWER FLOW (ESP32-like logic) ---
     # P2P TRADE: If both agents want to trade AND it's profitable
@@ -498,16 +1115,14 @@ def _process_negotiation(state, act_a, act_b):
     if p2p_possible and net_b < 0:
         # House A can sell from battery even if solar deficit
         # Trade amount: what B needs OR what A can spare from battery
-        available_from_battery_a = (battery_a - 20) / 100.0 * BATTERY_CAPACITY_KWH  # Keep 20% reserve
+        available_from_battery_a = (battery_a - 20) / 100.0 * CFG.battery_capacity_kwh  # Keep 20% reserve
         available_from_battery_a = max(0, available_from_battery_a)
         
-        trade_amount = min(-net_b, available_from_battery_a, P2P_TRADE_KWH)
+        trade_amount = min(-net_b, available_from_battery_a, CFG.p2p_trade_kwh)
         
         if trade_amount >= 0.1:
             # Negotiate a deal
-            agent_a = EnergyAgent("house_a", "PRODUCER")
-            agent_b = EnergyAgent("house_b", "CONSUMER")
-            deal = _negotiate_p2p_deal(state, agent_a, agent_b, trade_amount)
+            deal = _negotiate_p2p_deal(state, AGENT_A, AGENT_B, trade_amount)
             
             if deal is not None:
                 # Extract deal terms
@@ -521,14 +1136,19 @@ def _process_negotiation(state, act_a, act_b):
                 
                 # Log detailed negotiation
                 _log_to_firebase(
-                    f"💰 P2P NEGOTIATION:\n"
-                    f"  Seller bid: Rs {seller_bid}/unit | Buyer bid: Rs {buyer_bid}/unit\n"
-                    f"  ✅ DEAL @ Rs {agreed_price}/unit\n"
-                    f"  Seller profit: Rs {seller_total_profit:.1f} (Rs {deal['seller_profit_per_unit']:.1f}/unit)\n"
-                    f"  Buyer saves: Rs {buyer_total_savings:.1f} vs WAPDA (Rs {deal['buyer_savings_per_unit']:.1f}/unit)\n"
-                    f"  Buyer pays: Rs {buyer_total_with_rent}/unit | WAPDA: Rs {wapda_ref}/unit",
+                    "💰 P2P NEGOTIATION:\n"
+                    "  Seller bid: Rs %s/unit | Buyer bid: Rs %s/unit\n"
+                    "  ✅ DEAL @ Rs %s/unit\n"
+                    "  Seller profit: Rs %.1f (Rs %.1f/unit)\n"
+                    "  Buyer saves: Rs %.1f vs WAPDA (Rs %.1f/unit)\n"
+                    "  Buyer pays: Rs %s/unit | WAPDA: Rs %s/unit",
                     "transaction",
-                    "market"
+                    "market",
+                    seller_bid, buyer_bid,
+                    agreed_price,
+                    seller_total_profit, deal["seller_profit_per_unit"],
+                    buyer_total_savings, deal["buyer_savings_per_unit"],
+                    buyer_total_with_rent, wapda_ref,
                 )
                 
                 # Update wallets
@@ -538,11 +1158,11 @@ def _process_negotiation(state, act_a, act_b):
                 house_b_wallet = state["house_b"].get("wallet_balance", 0) - buyer_gross
                 
                 # Update batteries (A loses, B gains)
-                battery_delta = (trade_amount / BATTERY_CAPACITY_KWH) * 100
+                battery_delta = (trade_amount / CFG.battery_capacity_kwh) * 100
                 new_battery_a = max(0, battery_a - battery_delta)
                 new_battery_b = min(100, battery_b + battery_delta)
                 
-                updates = {
+                trade_updates = {
                     "/house_a/wallet_balance": house_a_wallet,
                     "/house_b/wallet_balance": house_b_wallet,
                     "/house_a/battery_level": new_battery_a,
@@ -565,7 +1185,7 @@ def _process_negotiation(state, act_a, act_b):
                     },
                     "/visuals/led_mode": "A_TO_B",
                 }
-                db.reference("/").update(updates)
+                pending.update(trade_updates)
                 
                 # Update local state
                 state["house_a"]["battery_level"] = new_battery_a
@@ -581,9 +1201,8 @@ def _process_negotiation(state, act_a, act_b):
                 
                 p2p_trade_happened = True  # Mark that P2P occurred
         
-                time.sleep(1)
-                db.reference("/market").update({"active_contract": False})
-                db.reference("/visuals").update({"led_mode": "IDLE"})
+                updates["/market/active_contract"] = False
+                updates["/visuals/led_mode"] = "IDLE"
                 
                 # Update net_b to reflect remaining deficit after P2P trade
                 net_b = net_b + trade_amount  # Reduce B's deficit by trade amount
@@ -601,10 +1220,10 @@ def _process_negotiation(state, act_a, act_b):
     
     if is_donation_window and solar_available and net_a > 0.5:
         donation_amount = min(net_a, state["house_a"].get("solar_output", 0))
-        _log_to_firebase(f"🕌 SubhanAllah! Energy {donation_amount:.2f} kWh donated to Masjid.", "charity", "house_a")
+        _log_to_firebase("🕌 SubhanAllah! Energy %.2f kWh donated to Masjid.", "charity", "house_a", donation_amount)
         current_donated = state.get("community", {}).get("total_donated_kwh", 0)
-        db.reference("/community").update({"total_donated_kwh": current_donated + donation_amount})
-        db.reference("/visuals").update({"led_mode": "A_TO_MASJID"})
+        updates["/community/total_donated_kwh"] = current_donated + donation_amount
+        updates["/visuals/led_mode"] = "A_TO_MASJID"
         active_actions.append({
             "code": 2,
             "label": "A_TO_MASJID",
@@ -616,10 +1235,8 @@ def _process_negotiation(state, act_a, act_b):
         # House A: Only buy from grid if P2P didn't happen (avoid double-spending)
         if net_a < 0 and not p2p_trade_happened:  # House A needs power
             cost = grid_price * (-net_a)
-            _log_to_firebase(f"🔌 House A charging from grid: {-net_a:.2f} kW @ Rs {grid_price}/unit = Rs {cost:.1f}", "grid_buy", "house_a")
-            db.reference("/house_a/wallet_balance").set(
-                state["house_a"].get("wallet_balance", 0) - cost
-            )
+            _log_to_firebase("🔌 House A charging from grid: %.2f kW @ Rs %s/unit = Rs %.1f", "grid_buy", "house_a", -net_a, grid_price, cost)
+            updates["/house_a/wallet_balance"] = state["house_a"].get("wallet_balance", 0) - cost
             active_actions.append({
                 "code": 3,
                 "label": "GRID_TO_A",
@@ -627,61 +1244,78 @@ def _process_negotiation(state, act_a, act_b):
             })
         if net_a > 0 and act_a == "SELL_TO_GRID" and solar_a > 0.1:  # House A has excess AND solar available
             revenue = grid_price * net_a
-            _log_to_firebase(f"🔋 House A selling to grid: {net_a:.2f} kW @ Rs {grid_price}/unit = Rs {revenue:.1f}", "grid_sell", "house_a")
-            db.reference("/house_a/wallet_balance").set(
-                state["house_a"].get("wallet_balance", 0) + revenue
-            )
+            _log_to_firebase("🔋 House A selling to grid: %.2f kW @ Rs %s/unit = Rs %.1f", "grid_sell", "house_a", net_a, grid_price, revenue)
+            updates["/house_a/wallet_balance"] = state["house_a"].get("wallet_balance", 0) + revenue
         elif net_a > 0 and act_a == "SELL_TO_GRID" and solar_a < 0.1:
-            _log_to_firebase(f"⚠️ House A attempted to sell at night (no solar). Action rejected.", "warning", "house_a")
+            _log_to_firebase("⚠️ House A attempted to sell at night (no solar). Action rejected.", "warning", "house_a")
         
         if net_b < 0:  # House B needs power
             cost = grid_price * (-net_b)
-            _log_to_firebase(f"🔌 House B charging from grid: {-net_b:.2f} kW @ Rs {grid_price}/unit = Rs {cost:.1f}", "grid_buy", "house_b")
-            db.reference("/house_b/wallet_balance").set(
-                state["house_b"].get("wallet_balance", 0) - cost
-            )
+            _log_to_firebase("🔌 House B charging from grid: %.2f kW @ Rs %s/unit = Rs %.1f", "grid_buy", "house_b", -net_b, grid_price, cost)
+            updates["/house_b/wallet_balance"] = state["house_b"].get("wallet_balance", 0) - cost
             active_actions.append({
                 "code": 4,
                 "label": "GRID_TO_B",
                 "reason": "House B deficit covered by grid."
             })
     else:
-        db.reference("/visuals").update({"led_mode": "BLACKOUT"})
+        updates["/visuals/led_mode"] = "BLACKOUT"
 
     # Update LED mode based on actions
-    if len(active_actions) > 0:
-        if any(a['code'] == 3 for a in active_actions) and any(a['code'] == 4 for a in active_actions):
-            db.reference("/visuals").update({"led_mode": "GRID_TO_BOTH"})
-        elif any(a['code'] == 3 for a in active_actions):
-            db.reference("/visuals").update({"led_mode": "GRID_TO_A"})
-        elif any(a['code'] == 4 for a in active_actions):
-            db.reference("/visuals").update({"led_mode": "GRID_TO_B"})
+    grid_led_mode = _GRID_LED_MODES.get(frozenset(a['code'] for a in active_actions) & {3, 4})
+    if grid_led_mode:
+        updates["/visuals/led_mode"] = grid_led_mode
 
     # Write all active actions to Firebase
     if len(active_actions) == 0:
         active_actions.append({"code": 0, "label": "IDLE", "reason": "No action required."})
-    
-    _write_actions_to_firebase(active_actions)
+    updates.update(_action_updates(active_actions))
+    if p2p_trade_happened:
+        # Let the A_TO_B pulse show for a second before the final LED state lands
+        pending.later.update({path: updates.pop(path) for path in ("/market/active_contract", "/visuals/led_mode")})
+    pending.update(updates)
+
 
+_quota_fallbacks = 0  # Decisions that fell back to the mock because of 429s
 
-def run_marketplace_loop():
+
+def _adapt_loop_delay(delay, quota_hit):
+    """AIMD pacing: double the delay after a quota fallback, halve it back toward CFG.loop_delay otherwise."""
+    if quota_hit:
+        return min(max(delay * 2, 1), CFG.max_loop_delay)
+    return max(delay / 2, CFG.loop_delay)
+
+
+async def run_marketplace_loop():
     _log_to_firebase("🚀 ECHO-GRID: Intelligent Agents Started...", "startup", "system")
-    
+
+    # Read the world once, then let RTDB stream changes (sensors, our own writes) into it
+    state = await asyncio.to_thread(get_full_state) or {}
+    # Events are applied on this loop's thread, between the loop's own reads of `state`
+    listeners = await asyncio.to_thread(listen_state, state, asyncio.get_running_loop())
+    delay = CFG.loop_delay
+    last_step_key = last_actions = None
+
     while True:
         try:
-            state = get_full_state()
             if not state or "grid" not in state or "simulation" not in state:
                 _log_to_firebase("⚠️ Missing world state. Resetting simulation...", "warning", "system")
-                reset_simulation()
-                time.sleep(1)
+                await asyncio.to_thread(reset_simulation)
+                await asyncio.sleep(1)
                 continue
             
-            # Run Agents
-            agent_a = EnergyAgent("house_a", "PRODUCER")
-            act_a = agent_a.reason_and_act(state)
-            
-            agent_b = EnergyAgent("house_b", "CONSUMER")
-            act_b = agent_b.reason_and_act(state)
+            # Run Agents (one Gemini request covers both houses), unless nothing
+            # they decide on has changed since the last tick
+            step_key = (state["simulation"].get("clock"), *(agent._state_key(state) for agent in AGENTS))
+            quota_before = _quota_fallbacks
+            pending = PendingWrites()
+            if step_key == last_step_key:
+                act_a, act_b = last_actions
+            else:
+                act_a, act_b = await reason_and_act_jointly(AGENTS, state, pending)
+            quota_hit = _quota_fallbacks > quota_before
+            # Mock fallbacks are not worth repeating once the quota recovers
+            last_step_key, last_actions = (None, None) if quota_hit else (step_key, (act_a, act_b))
             
             # --- THE HARDWARE BRIDGE (Translation Layer) ---
             hardware_action = 0  # Default OFF
@@ -690,90 +1324,105 @@ def run_marketplace_loop():
             if act_a == "OFFER_P2P" and act_b == "BUY_P2P":
                 _log_to_firebase("💸 TRADE SUCCESS: House A -> House B", "transaction", "market")
                 hardware_action = 1 
-                db.reference('/visuals').update({"led_mode": "A_TO_B"})
+                led_mode = "A_TO_B"
 
             # Logic 2: Masjid Donation (Action 2 -> Pin 25)
             elif act_a == "DONATE_MASJID":
                 _log_to_firebase("🕌 CHARITY: Donating to Masjid", "charity", "house_a")
                 hardware_action = 2
-                db.reference('/visuals').update({"led_mode": "MASJID"})
+                led_mode = "MASJID"
 
             # Logic 3: Charging from Grid (Action 3 -> Pin 26)
             elif act_a == "CHARGE_FROM_GRID":
                 _log_to_firebase("🔌 CHARGING: House A filling battery", "grid_buy", "house_a")
                 hardware_action = 3
-                db.reference('/visuals').update({"led_mode": "GRID_CHARGE"})
+                led_mode = "GRID_CHARGE"
 
             # Logic 4: Idle/Hold (Action 0 -> OFF)
             else:
                 hardware_action = 0
-                db.reference('/visuals').update({"led_mode": "IDLE"})
+                led_mode = "IDLE"
 
             # --- WRITE TO ESP32 PATH ---
-            # This is the line your ESP32 is waiting for!
-            db.reference('/controls').update({"action": hardware_action})
-            
-            time.sleep(LOOP_DELAY)
+            # This is the line your ESP32 is waiting for! (LEDs and agent logs go in the same write)
+            pending.update({
+                "/visuals/led_mode": led_mode,
+                "/controls/action": hardware_action,
+            })
+            pending.flush()
 
-        except KeyboardInterrupt:
+            delay = _adapt_loop_delay(delay, quota_hit)
+            await asyncio.sleep(delay)
+
+        except asyncio.CancelledError:
             _log_to_firebase("🛑 Simulation stopped by user.", "info", "system")
             break
         except Exception as e:
-            _log_to_firebase(f"⚠️ Loop Error: {e}", "error", "system")
-            time.sleep(LOOP_DELAY)
-
-
-def run_simulation_from_csv(path=SIM_DATA_PATH):
+            _log_to_firebase("⚠️ Loop Error: %s", "error", "system", e)
+            await asyncio.sleep(CFG.loop_delay)
+            try:
+                # The local copy may have missed updates; resync from a full read
+                apply_update(state, "/", await asyncio.to_thread(get_full_state))
+            except Exception:
+                pass
+    for listener in listeners:
+        listener.close()
+
+
+async def run_simulation_from_csv(path=CFG.sim_data_path):
     _log_to_firebase("🚀 ECHO-GRID: Dataset Simulation Initialized...", "startup", "system")
-    _log_to_firebase(f"📁 Dataset: {path} | Step: {STEP_MINUTES} min | Mock mode: {USE_MOCK}", "startup", "system")
-    rows = _load_simulation_rows(path)
-    if not rows:
+    _log_to_firebase("📁 Dataset: %s | Step: %s min | Mock mode: %s", "startup", "system", path, CFG.step_minutes, CFG.use_mock)
+    # The dataset is parsed and checked before the reset, so a bad file leaves Firebase untouched
+    sim = await asyncio.to_thread(_load_simulation_arrays, path)
+    row_count = len(sim["timestamp"])
+    if row_count == 0:
         raise RuntimeError("Simulation dataset is empty.")
+    await asyncio.to_thread(reset_simulation)
 
-    reset_simulation()
+    # This process is the only writer during a CSV run, so after one read the
+    # local state stays authoritative: each step mirrors its own writes into it.
+    state = await asyncio.to_thread(get_full_state) or {}
 
+    prefetch = None
     try:
-        for idx, row in enumerate(rows):
-            state = get_full_state() or {}
-            if not state:
-                reset_simulation()
-                state = get_full_state() or {}
-
-            updates = _update_world_from_row(row, state)
+        for idx in range(row_count):
+            updates = _update_world_from_index(idx, sim, state)
             updates.update(_apply_battery_dynamics(state))
-            updates["/simulation/current_row"] = {
-                "timestamp": row.get("timestamp", ""),
-                "grid_status": row.get("grid_status", ""),
-                "grid_price": row.get("grid_price", ""),
-                "house_a_solar": row.get("house_a_solar", ""),
-                "house_a_load": row.get("house_a_load", ""),
-                "house_b_solar": row.get("house_b_solar", ""),
-                "house_b_load": row.get("house_b_load", ""),
-                "index": idx,
-            }
-            db.reference("/").update(updates)
+            pending = PendingWrites()  # Everything this step changes goes out in one update
+            pending.update(updates)
 
             # Get agent decisions
-            agent_a = EnergyAgent("house_a", "PRODUCER")
-            act_a = agent_a.reason_and_act(state)
-
-            agent_b = EnergyAgent("house_b", "CONSUMER")
-            act_b = agent_b.reason_and_act(state)
+            if prefetch is not None:
+                await prefetch
+            act_a, act_b = await reason_and_act_jointly(AGENTS, state, pending)
 
             # Process negotiation with power-flow awareness (ESP32 model)
-            _process_negotiation(state, act_a, act_b)
-
-            print(f"[Step {idx+1}/{len(rows)}] {row['timestamp']} | Grid: {row['grid_status']} @ Rs {row['grid_price']}")
-            time.sleep(LOOP_DELAY)
-    except KeyboardInterrupt:
+            _process_negotiation(state, act_a, act_b, pending)
+            pending.flush(state)
+
+            prefetch = None
+            if idx + 1 < row_count and not CFG.use_mock:
+                prefetch = asyncio.create_task(_prefetch_decisions(AGENTS, state, idx + 1, sim))
+
+            row = {column: cells[idx] for column, cells in sim["text"].items()}
+            print(f"[Step {idx+1}/{row_count}] {row['timestamp']} | Grid: {row['grid_status']} @ Rs {row['grid_price']}")
+            await asyncio.sleep(CFG.loop_delay)
+    except asyncio.CancelledError:
+        if prefetch is not None:
+            prefetch.cancel()
         print("⏹️ Simulation stopped by user.")
 
 if __name__ == "__main__":
-    if LIST_MODELS:
+    if CFG.list_models:
         for model in client.models.list():
             print(model.name)
     else:
-        if os.path.exists(SIM_DATA_PATH):
-            run_simulation_from_csv(SIM_DATA_PATH)
-        else:
-            run_marketplace_loop()
\ No newline at end of file
+        if CFG.gemini_explicit_cache and not CFG.use_mock:
+            _enable_explicit_cache()
+        try:
+            if os.path.exists(CFG.sim_data_path):
+                asyncio.run(run_simulation_from_csv(CFG.sim_data_path))
+            else:
+                asyncio.run(run_marketplace_loop())
+        except KeyboardInterrupt:
+            pass  # Ctrl+C cancels the running loop, which reports the stop itself
\ No newline at end of file
@@ -0,0 +1,467 @@
+import streamlit as st
+import functools
+import time
+from dataclasses import dataclass, fields
+from typing import Final
+import plotly.graph_objects as go
+from firebase_manager import LOG_TAIL_SIZE, get_full_state_cached, get_recent_logs, latest_log_key, start_mirror
+
+
+def _ensure_streamlit_context():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except Exception:
+        return
+    if get_script_run_ctx() is None:
+        print("This app must be run with: streamlit run app.py")
+        raise SystemExit(0)
+
+
+# --- CUSTOM CSS (For that "Cyberpunk/Fintech" look) ---
+# Joined once at import into one compact <style> tag. It is still emitted on
+# every run, because Streamlit drops elements a full rerun does not re-send.
+_CSS_RULES = (
+    ".big-font { font-size: 24px !important; font-weight: bold; }",
+    ".stMetric { background-color: #1E1E1E; padding: 15px; border-radius: 10px; border: 1px solid #333; }",
+    ".success-text { color: #00FF00; }",
+    ".danger-text { color: #FF0000; }",
+)
+_CSS_BLOCK: Final[str] = "<style>" + "".join(_CSS_RULES) + "</style>"
+
+
+def setup_page() -> None:
+    _ensure_streamlit_context()
+    # The first snapshot streams in while the page chrome is being sent
+    start_mirror()
+
+    # --- PAGE CONFIGURATION ---
+    st.set_page_config(
+        page_title="ECHO-GRID | Decentralized Energy Trading",
+        page_icon="⚡",
+        layout="wide",
+        initial_sidebar_state="collapsed"
+    )
+    st.markdown(_CSS_BLOCK, unsafe_allow_html=True)
+
+
+# Color-code by type
+_ICON_MAP = {
+    "decision": "🤖",
+    "transaction": "💰",
+    "charity": "🕌",
+    "grid_buy": "🔌",
+    "grid_sell": "🔋",
+    "error": "❌",
+    "warning": "⚠️",
+    "startup": "🚀",
+}
+_DEFAULT_ICON = "📋"
+
+# Terminal lines already formatted, by push key (log entries never change once written)
+_LOG_LINES: dict[str, str] = {}
+
+
+# Last feed built: (newest push key, limit, lines). Ticks with no new log reuse it.
+_LOG_FEED: tuple[str, int, tuple[str, ...]] = ("", 0, ())
+
+
+def _fetch_logs(limit: int = 100) -> tuple[str, ...]:
+    global _LOG_FEED
+    try:
+        if _LOG_FEED[:2] == (latest_log_key(), limit):
+            return _LOG_FEED[2]
+        logs = get_recent_logs(limit)
+    except Exception:
+        return ()
+
+    entries = []
+    for key, item in logs:
+        line = _LOG_LINES.get(key)
+        if line is None:
+            line = _LOG_LINES[key] = (
+                f"[{item.get('timestamp', '--:--:--')}] {_ICON_MAP.get(item.get('type'), _DEFAULT_ICON)} "
+                f"{item.get('agent', 'system').upper()}: {item.get('message', '')}"
+            )
+        entries.append(line)
+
+    if len(_LOG_LINES) > 2 * LOG_TAIL_SIZE:
+        _LOG_LINES.clear()
+        _LOG_LINES.update(zip((key for key, _ in logs), entries))
+    _LOG_FEED = (logs[-1][0] if logs else "", limit, tuple(entries))
+    return _LOG_FEED[2]
+
+
+def _fallback_logs() -> list[str]:
+    try:
+        data = get_full_state_cached() or {}
+    except Exception:
+        return []
+
+    house_a = data.get("house_a", {})
+    house_b = data.get("house_b", {})
+    market = data.get("market", {})
+    entries = []
+    timestamp = time.strftime("%H:%M:%S")
+    if house_a.get("agent_log"):
+        entries.append(f"[{timestamp}] house_a: {house_a.get('agent_log')}")
+    if house_b.get("agent_log"):
+        entries.append(f"[{timestamp}] house_b: {house_b.get('agent_log')}")
+    if market.get("latest_transaction"):
+        entries.append(f"[{timestamp}] market: {market.get('latest_transaction')}")
+    return entries
+
+
+# --- TYPED SNAPSHOTS ---
+# Each rerun converts the nodes it renders once; fields missing from Firebase
+# fall back to the defaults below (GridState.status is required).
+class _FromDict:
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**{f.name: data[f.name] for f in fields(cls) if f.name in data})
+
+
+@dataclass(slots=True)
+class HouseState(_FromDict):
+    role: str = ""
+    solar_output: float = 0.0
+    battery_level: float = 0.0
+    wallet_balance: float = 0.0
+    current_load: float = 0.0
+    agent_log: str = "Sleeping..."
+
+
+@dataclass(slots=True)
+class GridState(_FromDict):
+    status: str
+    price_per_unit: float = 0.0
+    voltage: float = 0.0
+
+
+@dataclass(slots=True)
+class MarketState(_FromDict):
+    latest_transaction: str = "P2P Trade"
+    transaction_price: float = 0.0
+    active_contract: bool = False
+
+
+INITIAL_WALLETS = {
+    "house_a": 5000,
+    "house_b": 2000,
+}
+
+STEP_HOURS = 0.5
+WAPDA_BUY_RATE = 11.0
+
+
+def _calc_step_metrics(house: HouseState, baseline_wallet: float, grid_price: float) -> dict:
+    load_w = float(house.current_load)
+    solar_kw = float(house.solar_output)
+    battery = float(house.battery_level)
+    wallet = float(house.wallet_balance)
+
+    load_kw = load_w / 1000.0
+    load_kwh = load_kw * STEP_HOURS
+    solar_kwh = solar_kw * STEP_HOURS
+    solar_used_kwh = min(load_kwh, solar_kwh)
+    export_kwh = max(0.0, solar_kwh - load_kwh)
+    net_kw = solar_kw - load_kw
+    net_kwh = net_kw * STEP_HOURS
+
+    wapda_cost = load_kwh * grid_price
+    wapda_export_revenue = export_kwh * WAPDA_BUY_RATE
+
+    # For Agent A (producer): What they could have earned exporting to WAPDA
+    # For Agent B (consumer): What it would have cost buying from WAPDA
+    estimated_saved = wapda_export_revenue
+
+    net_overall = wallet - baseline_wallet
+    made_total = net_overall
+
+    return {
+        "load_w": load_w,
+        "load_kwh": load_kwh,
+        "solar_kw": solar_kw,
+        "solar_kwh": solar_kwh,
+        "battery": battery,
+        "net_kw": net_kw,
+        "net_kwh": net_kwh,
+        "wapda_cost": wapda_cost,
+        "wapda_export_revenue": wapda_export_revenue,
+        "estimated_saved": estimated_saved,
+        "net_overall": net_overall,
+        "made_total": made_total,
+    }
+
+
+# Metric labels repeat between ticks; format each distinct value once
+@functools.lru_cache(maxsize=256)
+def _rs(value: float) -> str:
+    return f"Rs {value:.0f}"
+
+
+@functools.lru_cache(maxsize=256)
+def _kwh(value: float) -> str:
+    return f"{value:.2f} kWh"
+
+
+@functools.lru_cache(maxsize=256)
+def _pct(value: float) -> str:
+    return f"{value:.0f}%"
+
+
+def render_dashboard():
+    # --- THE LIVE LOOP (The "Magic" Part) ---
+    # We use a placeholder container to refresh ONLY the data, not the whole page.
+    dashboard = st.empty()
+    enable_live = st.toggle("Enable Live Feed", value=True)
+
+    # 1. FETCH REAL-TIME DATA
+    try:
+        data = get_full_state_cached()
+        grid = GridState.from_dict(data['grid'])
+        house_a = HouseState.from_dict(data['house_a'])
+        house_b = HouseState.from_dict(data['house_b'])
+        market = MarketState.from_dict(data['market'])
+    except:
+        st.error("Waiting for Firebase Connection...")
+        if enable_live:
+            # No fragments are mounted yet, so retry with a page refresh
+            _auto_refresh(interval_ms=2000)
+        return
+    grid_price = float(grid.price_per_unit)
+
+    # --- HEADER SECTION ---
+    col1, col2 = st.columns([1, 4])
+    with col1:
+        st.image("https://cdn-icons-png.flaticon.com/512/3103/3103446.png", width=80) # Placeholder Icon
+    with col2:
+        st.title("ECHO-GRID DASHBOARD")
+        st.markdown("### ⚡ Live P2P Energy Market (Agent View)")
+
+    st.divider()
+
+    # --- TOP BAR ---
+    _live_fragment(_render_top_bar, run_every=2, live=enable_live)()
+
+    with dashboard.container():
+        # --- ROW 1: MARKET STATUS ---
+        _live_fragment(_render_kpis, run_every=2, live=enable_live)()
+
+        st.divider()
+
+        tab_terminal, tab_a, tab_b = st.tabs([
+            "🧾 Terminal",
+            "🏠 Agent A Usage",
+            "🏢 Agent B Usage",
+        ])
+
+        with tab_terminal:
+            st.subheader("📡 Agent Communication Terminal")
+
+            _live_fragment(_render_logs_section, run_every=2, live=enable_live)()
+
+            st.divider()
+
+            # Track live log changes for display
+            house_a_log = house_a.agent_log
+            house_b_log = house_b.agent_log
+
+            c1, c2 = st.columns([2, 1])
+            with c1:
+                st.subheader("🤖 Agent Negotiation Terminal")
+
+                # Chat Interface Style for Logs
+                with st.container(height=300):
+                    # House A Log
+                    st.markdown(f"**🏠 House A (Seller):**")
+                    st.info(f"_{house_a_log}_")
+
+                    # House B Log
+                    st.markdown(f"**🏢 House B (Buyer):**")
+                    st.warning(f"_{house_b_log}_")
+
+                    # Market Contract
+                    if market.active_contract:
+                        st.success(f"✅ **CONTRACT EXECUTED:** {market.latest_transaction}")
+                    else:
+                        st.markdown("--- _Waiting for market match_ ---")
+
+            with c2:
+                st.subheader("🔋 Energy Flow")
+
+                # Charts can refresh slower than the logs
+                _live_fragment(_render_energy_chart, run_every=5, live=enable_live)()
+
+                # THEFT DETECTION BUTTON (The "Judge Pleaser")
+                if st.button("🚨 RUN GRID DIAGNOSTIC", type="primary", width='stretch'):
+                    st.toast("Scanning Grid lines...", icon="📡")
+                    st.session_state["_diag_start"] = time.time()
+                if "_diag_start" in st.session_state:
+                    _live_fragment(_poll_diagnostic, run_every=0.25, live=True)()
+                elif st.session_state.pop("_diag_result", False):
+                    st.error("⚠️ THEFT DETECTED: Line Loss > 15% at Sector G-11")
+                    # Optional: Write to firebase to trigger Red LEDs
+                    # db.reference('/visuals').update({"led_mode": "THEFT_ALERT"})
+
+        with tab_a:
+            st.subheader("⚡ Current Usage & Electricity — Agent A")
+            a = _calc_step_metrics(house_a, INITIAL_WALLETS["house_a"], grid_price)
+
+            st.markdown("### Money & WAPDA Comparison")
+            a1, a2, a3, a4 = st.columns(4)
+            a1.metric("Could Earn to WAPDA (PKR)", _rs(a['wapda_export_revenue']))
+            a2.metric("WAPDA Load Cost (PKR)", _rs(a['wapda_cost']))
+            a3.metric("How Much Made Now (PKR)", _rs(a['net_overall']))
+            a4.metric("Gain vs Initial (PKR)", _rs(max(0, a['net_overall'])))
+
+            st.divider()
+            st.markdown("### Battery & Units")
+            a5, a6, a7, a8 = st.columns(4)
+            a5.metric("Battery Level", _pct(a['battery']))
+            a6.metric("Load (kWh/step)", _kwh(a['load_kwh']))
+            a7.metric("Solar (kWh/step)", _kwh(a['solar_kwh']))
+            a8.metric("Net (kWh/step)", _kwh(a['net_kwh']))
+
+        with tab_b:
+            st.subheader("⚡ Current Usage & Electricity — Agent B")
+            b = _calc_step_metrics(house_b, INITIAL_WALLETS["house_b"], grid_price)
+
+            st.markdown("### Money & WAPDA Comparison")
+            b1, b2, b3, b4 = st.columns(4)
+            b1.metric("Would Cost from WAPDA (PKR)", _rs(b['wapda_cost']))
+            b2.metric("Actually Spent (PKR)", _rs(abs(min(0, b['net_overall']))))
+            b3.metric("How Much Saved (PKR)", _rs(max(0, b['wapda_cost'] - abs(min(0, b['net_overall'])))))
+            b4.metric("Net Overall (PKR)", _rs(b['net_overall']))
+
+            st.divider()
+            st.markdown("### Battery & Units")
+            b5, b6, b7, b8 = st.columns(4)
+            b5.metric("Battery Level", _pct(b['battery']))
+            b6.metric("Load (kWh/step)", _kwh(b['load_kwh']))
+            b7.metric("Solar (kWh/step)", _kwh(b['solar_kwh']))
+            b8.metric("Net (kWh/step)", _kwh(b['net_kwh']))
+
+    # Streamlit without fragments: refresh the whole page once it has rendered
+    if enable_live and not hasattr(st, "fragment"):
+        _auto_refresh(interval_ms=2000)
+
+
+
+def _auto_refresh(interval_ms: int) -> None:
+    try:
+        from streamlit_autorefresh import st_autorefresh
+
+        st_autorefresh(interval=interval_ms, key="live_refresh")
+    except Exception:
+        # Fallback: let the browser reload the page instead of sleeping on the script thread
+        import streamlit.components.v1 as components
+
+        components.html(
+            f"<script>setTimeout(() => window.parent.location.reload(), {interval_ms})</script>",
+            height=0,
+        )
+
+# --- LIVE FRAGMENTS (auto-refresh only these sections when supported) ---
+def _live_fragment(render, run_every: float, live: bool):
+    """Wrap `render` so it reruns on its own every `run_every` seconds while `live`."""
+    if not hasattr(st, "fragment"):
+        return render
+    return st.fragment(render, run_every=run_every if live else None)
+
+
+def _render_top_bar() -> None:
+    data = get_full_state_cached() or {}
+    top1, top2, top3 = st.columns(3)
+    sim_time = data.get('simulation', {}).get('clock', 'Unknown')
+    donated_kwh = data.get('community', {}).get('total_donated_kwh', 0)
+    grid_status = data.get('grid', {}).get('status', 'UNKNOWN')
+    top1.metric("🕒 Simulation Time", sim_time)
+    top2.metric("🕌 Energy Donated", f"{donated_kwh} kWh", delta="Social Good")
+    top3.metric(
+        "Grid Status",
+        grid_status,
+        delta_color="off" if grid_status == "OFF" else "normal"
+    )
+
+
+def _render_kpis() -> None:
+    try:
+        data = get_full_state_cached()
+        grid = GridState.from_dict(data['grid'])
+        house_a = HouseState.from_dict(data['house_a'])
+        house_b = HouseState.from_dict(data['house_b'])
+    except Exception:
+        return
+
+    kpi1, kpi2, kpi3 = st.columns(3)
+
+    # Grid Status
+    grid_status = "ONLINE 🟢" if grid.status == "ONLINE" else "BLACKOUT 🔴"
+    kpi1.metric("Grid Status", grid_status, delta="Stable")
+
+    # House A Wallet (The Seller)
+    kpi2.metric("House A Wallet", f"Rs {house_a.wallet_balance}", delta="Producer")
+
+    # House B Wallet (The Buyer)
+    kpi3.metric("House B Wallet", f"Rs {house_b.wallet_balance}", delta="Consumer", delta_color="off")
+
+
+@st.cache_resource(max_entries=128)
+def _battery_donut(battery_a: int, battery_b: int) -> go.Figure:
+    """Simple Donut Chart for Battery, built once per battery pair."""
+    fig = go.Figure(data=[go.Pie(
+        labels=['Battery A', 'Battery B', 'Grid Load'],
+        values=[battery_a, battery_b, 100],
+        hole=.6,
+        marker_colors=['#00CC96', '#EF553B', '#636EFA']
+    )])
+    fig.update_layout(showlegend=False, height=250, margin=dict(t=0, b=0, l=0, r=0))
+    return fig
+
+
+def _render_energy_chart() -> None:
+    try:
+        data = get_full_state_cached()
+        house_a = HouseState.from_dict(data['house_a'])
+        house_b = HouseState.from_dict(data['house_b'])
+    except Exception:
+        return
+
+    # Whole percentages keep the figure cache hit rate high. The chart is sent
+    # on every tick even when unchanged: a fragment rerun removes any element
+    # it does not redraw, so skipping the call would blank the donut.
+    st.plotly_chart(
+        _battery_donut(round(house_a.battery_level), round(house_b.battery_level)),
+        width='stretch',
+    )
+
+
+DIAGNOSTIC_SECONDS = 1.0
+
+
+def _poll_diagnostic() -> None:
+    """Finish a started grid scan after DIAGNOSTIC_SECONDS without blocking the script thread."""
+    remaining = st.session_state["_diag_start"] + DIAGNOSTIC_SECONDS - time.time()
+    if remaining > 0:
+        if hasattr(st, "fragment"):
+            return  # Checked again on the next fragment tick
+        time.sleep(remaining)
+    del st.session_state["_diag_start"]
+    st.session_state["_diag_result"] = True
+    st.rerun()
+
+
+def _render_logs_section() -> None:
+    with st.container(height=500):
+        entries = _fetch_logs(limit=200)
+        
+        if not entries:
+            entries = _fallback_logs()
+        if not entries:
+            st.markdown("_No activity yet. Waiting for agents..._")
+        else:
+            # One element for the whole feed (two trailing spaces = markdown line break)
+            st.markdown("  \n".join(entries))
+
@@ -1,5 +1,9 @@
+import copy
 import json
 import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import firebase_admin
 from firebase_admin import credentials, db
 import random
@@ -11,16 +15,18 @@ SERVICE_ACCOUNT_PATH = os.getenv("SERVICE_ACCOUNT_PATH", "serviceAccountKey.json
 if not os.path.exists(SERVICE_ACCOUNT_PATH):
     raise FileNotFoundError(f"Service account key not found at {SERVICE_ACCOUNT_PATH}. Set SERVICE_ACCOUNT_PATH env var or ensure serviceAccountKey.json exists.")
 
-cred = credentials.Certificate(SERVICE_ACCOUNT_PATH)
-
+# Parse the key once; credentials.Certificate accepts the dict directly
 with open(SERVICE_ACCOUNT_PATH, "r", encoding="utf-8") as key_file:
-    project_id = json.load(key_file).get("project_id")
-    if not project_id:
-        raise RuntimeError(f"serviceAccountKey.json at {SERVICE_ACCOUNT_PATH} missing project_id")
+    _service_account = json.load(key_file)
+project_id = _service_account.get("project_id")
+if not project_id:
+    raise RuntimeError(f"serviceAccountKey.json at {SERVICE_ACCOUNT_PATH} missing project_id")
+DATABASE_URL = f"https://{project_id}-default-rtdb.firebaseio.com/"
 
 if not firebase_admin._apps:
+    cred = credentials.Certificate(_service_account)
     firebase_admin.initialize_app(cred, {
-        "databaseURL": f"https://{project_id}-default-rtdb.firebaseio.com/"
+        "databaseURL": DATABASE_URL
     })
 
 # --- CONTROLLERS ---
@@ -76,10 +82,137 @@ def update_sensor_data(house, key, value):
     ref = db.reference(f'/{house}')
     ref.update({key: value})
 
+# Top-level nodes the simulation reads back. /logs is append-only and grows
+# without bound, so it is left out of snapshots.
+STATE_PATHS = ('grid', 'house_a', 'house_b', 'market', 'simulation', 'community', 'visuals', 'controls')
+_READ_POOL = ThreadPoolExecutor(max_workers=len(STATE_PATHS), thread_name_prefix='firebase-read')
+
 def get_full_state():
-    """Returns the entire JSON snapshot."""
-    ref = db.reference('/')
-    return ref.get()
+    """Returns the JSON snapshot of every STATE_PATHS node, fetched in parallel."""
+    futures = {path: _READ_POOL.submit(db.reference(f'/{path}').get) for path in STATE_PATHS}
+    snapshot = {path: future.result() for path, future in futures.items()}
+    return {path: value for path, value in snapshot.items() if value is not None}
+
+def apply_update(state, path, value):
+    """Mirror a write at `path` into the local `state` dict (None deletes, as in RTDB)."""
+    keys = [key for key in path.strip('/').split('/') if key]
+    if not keys:
+        state.clear()
+        state.update(value or {})
+        return
+    node = state
+    for key in keys[:-1]:
+        child = node.get(key)
+        if not isinstance(child, dict):
+            child = node[key] = {}
+        node = child
+    if value is None:
+        node.pop(keys[-1], None)
+    else:
+        node[keys[-1]] = value
+
+def _apply_event(state, event, root=''):
+    """Fold one RTDB stream event from a listener on `root` into `state`; returns the absolute paths it wrote."""
+    path = f"{root}{event.path}"
+    if event.event_type == 'put':
+        apply_update(state, path, event.data)
+        return [path]
+    if event.event_type == 'patch':
+        paths = [f"{path.rstrip('/')}/{key}" for key in (event.data or {})]
+        for path, value in zip(paths, (event.data or {}).values()):
+            apply_update(state, path, value)
+        return paths
+    return []
+
+def listen_state(state, loop=None):
+    """Keep `state` in sync with the STATE_PATHS nodes via RTDB streaming instead of polling.
+
+    Each node's first event is its full snapshot; later events carry only what
+    changed. /logs is not streamed (see STATE_PATHS). With `loop`, events are
+    applied on that asyncio loop's thread, so code running there never sees a
+    half-applied event. Returns the listener registrations (call .close() on each to stop).
+    """
+    def on_event(root):
+        if loop is None:
+            return lambda event: _apply_event(state, event, root)
+        return lambda event: loop.call_soon_threadsafe(_apply_event, state, event, root)
+    return [db.reference(f'/{path}').listen(on_event(f'/{path}')) for path in STATE_PATHS]
+
+# --- LIVE MIRROR (dashboard) ---
+# One listener per STATE_PATHS node keeps a local copy of the state, so dashboard
+# reruns read memory instead of re-downloading it. /logs is never streamed: only
+# the newest LOG_TAIL_SIZE entries are kept, in push-key order, and refreshed
+# with a small keyed query for entries newer than the tail.
+LOG_TAIL_SIZE = 200
+LOG_POLL_SECONDS = 1.0
+_STATE_CACHE = {}
+_LOG_TAIL = deque(maxlen=LOG_TAIL_SIZE)  # (push_key, entry)
+_LISTENERS = None
+_NODES_SEEN = set()
+_STATE_READY = threading.Event()
+_LISTENER_LOCK = threading.Lock()
+_MIRROR_LOCK = threading.Lock()
+_LOG_LOCK = threading.Lock()
+_log_polled_at = None
+
+def _mirror_handler(root):
+    def on_event(event):
+        with _MIRROR_LOCK:
+            _apply_event(_STATE_CACHE, event, root)
+            _NODES_SEEN.add(root)
+            if len(_NODES_SEEN) == len(STATE_PATHS):
+                _STATE_READY.set()
+    return on_event
+
+def _start_listener(timeout=10.0):
+    """Start the mirror listeners once and wait (up to `timeout`) for every node's first snapshot."""
+    global _LISTENERS
+    with _LISTENER_LOCK:
+        if _LISTENERS is None:
+            _LISTENERS = [db.reference(f'/{path}').listen(_mirror_handler(f'/{path}')) for path in STATE_PATHS]
+    _STATE_READY.wait(timeout)
+
+def start_mirror():
+    """Open the mirror streams without waiting, so the first snapshots download in the background."""
+    _start_listener(timeout=0)
+
+def _poll_log_tail():
+    """Append /logs entries newer than the tail, at most once per LOG_POLL_SECONDS."""
+    global _log_polled_at
+    with _LOG_LOCK:
+        now = time.monotonic()
+        if _log_polled_at is not None and now - _log_polled_at < LOG_POLL_SECONDS:
+            return
+        query = db.reference('/logs').order_by_key()
+        newest = _LOG_TAIL[-1][0] if _LOG_TAIL else None
+        if newest is not None:
+            query = query.start_at(newest)
+        fresh = query.limit_to_last(LOG_TAIL_SIZE).get() or {}
+        _log_polled_at = now
+        # start_at is inclusive: without the newest key, /logs was reset or a full tail arrived
+        if newest not in fresh:
+            _LOG_TAIL.clear()
+            newest = None
+        _LOG_TAIL.extend((key, fresh[key]) for key in sorted(fresh)
+                         if (newest is None or key > newest) and isinstance(fresh[key], dict))
+
+def get_full_state_cached():
+    """Snapshot of the live mirror (STATE_PATHS only; see get_recent_logs)."""
+    _start_listener()
+    with _MIRROR_LOCK:
+        return copy.deepcopy(_STATE_CACHE)
+
+def get_recent_logs(limit=LOG_TAIL_SIZE):
+    """The newest `limit` /logs entries as (push_key, entry) pairs, oldest first."""
+    _poll_log_tail()
+    with _LOG_LOCK:
+        return list(_LOG_TAIL)[-limit:]
+
+def latest_log_key():
+    """Push key of the newest /logs entry ('' when there are none)."""
+    _poll_log_tail()
+    with _LOG_LOCK:
+        return _LOG_TAIL[-1][0] if _LOG_TAIL else ''
 
 if __name__ == "__main__":
     reset_simulation()
\ No newline at end of file
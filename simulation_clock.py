@@ -1,33 +1,88 @@
-import pandas as pd
-import time
+import asyncio
+import csv
+import logging
+import os
 from firebase_manager import db
 
-def run_simulation():
-    df = pd.read_csv("simulation_data.csv")
-    print("⏳ Starting 24-Hour Simulation Loop...")
+# Tick messages are only %-formatted when they pass LOG_LEVEL (e.g. WARNING silences them)
+# An empty LOG_LEVEL (as copied from .env.example) means INFO
+logging.basicConfig(level=(os.getenv("LOG_LEVEL") or "INFO").strip().upper(), format="%(message)s")
+logger = logging.getLogger("echo_grid.clock")
+
+# Firebase path -> CSV column, pushed as one multi-path update per tick
+UPDATE_PATHS = {
+    "simulation/clock": "timestamp",
+    "grid/status": "grid_status",
+    "grid/price": "grid_price",
+
+    # House A (Producer) Physical Inputs
+    "house_a/solar_input": "house_a_solar",
+    "house_a/current_load": "house_a_load",
+
+    # House B (Consumer) Physical Inputs
+    "house_b/current_load": "house_b_load",
+}
+
+# Column -> parser for the fields the clock publishes. Numbers are parsed as
+# Python floats; float32 would publish 4.41 as 4.409999847412109.
+CSV_TYPES = {
+    "timestamp": str,
+    "grid_status": str,
+    "grid_price": float,
+    "house_a_solar": float,
+    "house_a_load": float,
+    "house_b_load": float,
+}
+
+def load_rows(path="simulation_data.csv"):
+    """Parse the schedule with the csv module; the columns are fixed, so pandas isn't needed."""
+    with open(path, newline="", encoding="utf-8") as csv_file:
+        return [{column: parse(raw[column]) for column, parse in CSV_TYPES.items()}
+                for raw in csv.DictReader(csv_file)]
+
+TICK_SECONDS = float(os.getenv("SIMULATION_TICK_SECONDS") or 8.0)
+
+# Ticks per multi-location update when the day is replayed in bulk
+HISTORY_CHUNK = 500
+
+def upload_history(schedule, root_ref):
+    """Write every tick under simulation/history/<index>, HISTORY_CHUNK ticks per update."""
+    for start in range(0, len(schedule), HISTORY_CHUNK):
+        root_ref.update({
+            f"simulation/history/{index:04d}/{path}": value
+            for index, updates in enumerate(schedule[start:start + HISTORY_CHUNK], start)
+            for path, value in updates.items()
+        })
+
+async def run_simulation():
+    # 1. World State updates for every tick, built before the loop starts
+    schedule = [{path: row[column] for path, column in UPDATE_PATHS.items()} for row in load_rows()]
+    logger.info("⏳ Starting 24-Hour Simulation Loop...")
+    root_ref = db.reference('/')
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+
+    if TICK_SECONDS <= 0 and schedule:
+        # Zero-delay playback: nothing can react between ticks, so the day goes
+        # up in a few bulk writes and the live nodes jump to the final tick
+        await asyncio.to_thread(upload_history, schedule, root_ref)
+        await asyncio.to_thread(root_ref.update, schedule[-1])
+        logger.info("⏰ SIM TIME: %s | %d ticks replayed", schedule[-1]['simulation/clock'], len(schedule))
+        return
     
-    # We loop through the CSV rows
-    for index, row in df.iterrows():
-        print(f"⏰ SIM TIME: {row['timestamp']} | Grid: {row['grid_status']}")
-        
-        # 1. Update World State in Firebase
-        updates = {
-            "simulation/clock": row['timestamp'],
-            "grid/status": row['grid_status'],
-            "grid/price": row['grid_price'],
-            
-            # House A (Producer) Physical Inputs
-            "house_a/solar_input": row['house_a_solar'],
-            "house_a/current_load": row['house_a_load'],
-            
-            # House B (Consumer) Physical Inputs
-            "house_b/current_load": row['house_b_load']
-        }
-        
-        db.reference('/').update(updates)
+    # We loop through the precomputed ticks
+    for updates in schedule:
+        # Ticks run on a fixed cadence: time spent on a slow write comes out of
+        # the next wait instead of stretching the simulated day
+        deadline += TICK_SECONDS
+        logger.info("⏰ SIM TIME: %s | Grid: %s", updates['simulation/clock'], updates['grid/status'])
         
-        # 2. Wait for Agents to React (5 Seconds = 30 simulated minutes)
-        time.sleep(8) 
+        # 2. Give the Agents TICK_SECONDS to React (one tick = 30 simulated minutes)
+        # The write runs in a worker thread, so its round-trip overlaps the wait
+        await asyncio.gather(
+            asyncio.to_thread(root_ref.update, updates),
+            asyncio.sleep(max(0.0, deadline - loop.time())),
+        )
 
 if __name__ == "__main__":
-    run_simulation()
\ No newline at end of file
+    asyncio.run(run_simulation())
\ No newline at end of file
@@ -1,20 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
 from firebase_manager import db
 import time
 
+controls_ref = db.reference('/controls')
+# One writer thread keeps the actions in order while each write's round-trip
+# overlaps the 2s pause instead of adding to it
+writer = ThreadPoolExecutor(max_workers=1)
+
 print("💡 TESTING HARDWARE...")
 
 print("👉 Sending Action 1 (Pin 14)...")
-db.reference('/controls').update({"action": 1})
+write = writer.submit(controls_ref.update, {"action": 1})
 time.sleep(2)
+write.result()  # Re-raises a failed write before the next action
 
 print("👉 Sending Action 2 (Pin 25)...")
-db.reference('/controls').update({"action": 2})
+write = writer.submit(controls_ref.update, {"action": 2})
 time.sleep(2)
+write.result()
 
 print("👉 Sending Action 3 (Pin 26)...")
-db.reference('/controls').update({"action": 3})
+write = writer.submit(controls_ref.update, {"action": 3})
 time.sleep(2)
+write.result()
 
 print("👉 Turning OFF...")
-db.reference('/controls').update({"action": 0})
-print("✅ Test Complete.")
\ No newline at end of file
+writer.submit(controls_ref.update, {"action": 0}).result()
+writer.shutdown()
+print("✅ Test Complete.")